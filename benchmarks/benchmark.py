@@ -0,0 +1,126 @@
+"""
+Benchmarks for pyFortiManagerAPI against the local MockFortiManager server.
+
+Measures request throughput and latency percentiles, memory used by large gets,
+and the throughput of bulk address object pushes.
+
+    python benchmarks/benchmark.py --addresses 100000 --latency 0.002
+    python benchmarks/benchmark.py --json > results.json
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from pyFortiManagerAPI import FortiManager  # noqa: E402
+from pyFortiManagerMock import MockFortiManager  # noqa: E402
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def bench_requests(fortimngr, requests, concurrency):
+    """
+    Throughput and latency of small get requests sent from concurrency threads
+    """
+    names = [f"GROUP_{index % 10}" for index in range(requests)]
+
+    def timed(name):
+        start = time.perf_counter()
+        fortimngr.get_address_groups(name=name)
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = list(executor.map(timed, names))
+    elapsed = time.perf_counter() - start
+    return {
+        "requests": requests,
+        "concurrency": concurrency,
+        "requests_per_second": round(requests / elapsed, 1),
+        "p50_ms": round(statistics.median(latencies) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+    }
+
+
+def bench_memory(fortimngr, page_size):
+    """
+    Time and peak Python memory of reading the whole address object table in one get and page by page
+    """
+    results = {}
+    for name, read in (("get", lambda: len(fortimngr.get_firewall_address_objects()[0]["data"])),
+                       ("iter", lambda: sum(1 for _ in fortimngr.iter_firewall_address_objects(page_size=page_size))),
+                       ("get_fields", lambda: len(fortimngr.get_firewall_address_objects(
+                           fields=["name", "subnet"])[0]["data"]))):
+        tracemalloc.start()
+        start = time.perf_counter()
+        count = read()
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        results[name] = {"entries": count, "seconds": round(elapsed, 3), "peak_mib": round(peak / 2 ** 20, 2)}
+    return results
+
+
+def bench_push(fortimngr, objects, chunk_size):
+    """
+    Objects per second created one call at a time and with a batch
+    """
+    results = {}
+    single = max(1, objects // 10)
+    start = time.perf_counter()
+    for index in range(single):
+        subnet = [f"172.16.{index // 256 % 256}.{index % 256}", "255.255.255.255"]
+        fortimngr.add_firewall_address_object(name=f"SINGLE_{index}", subnet=subnet)
+    results["single"] = {"objects": single, "objects_per_second": round(single / (time.perf_counter() - start), 1)}
+    start = time.perf_counter()
+    with fortimngr.batch(chunk_size=chunk_size) as batch:
+        for index in range(objects):
+            subnet = [f"192.168.{index // 256 % 256}.{index % 256}", "255.255.255.255"]
+            batch.add_firewall_address_object(name=f"BATCH_{index}", subnet=subnet)
+    results["batch"] = {"objects": objects, "chunk_size": chunk_size,
+                        "objects_per_second": round(objects / (time.perf_counter() - start), 1)}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--addresses", type=int, default=20000, help="address objects in the mock dataset")
+    parser.add_argument("--policies", type=int, default=5000, help="policies in the mock dataset")
+    parser.add_argument("--latency", type=float, default=0.001, help="seconds added to every mock request")
+    parser.add_argument("--requests", type=int, default=2000, help="requests sent by the throughput benchmark")
+    parser.add_argument("--concurrency", type=int, default=8, help="threads used by the throughput benchmark")
+    parser.add_argument("--push", type=int, default=5000, help="address objects pushed by the bulk benchmark")
+    parser.add_argument("--chunk-size", type=int, default=500, help="operations per batched request")
+    parser.add_argument("--page-size", type=int, default=1000, help="entries per page for iterators")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    with MockFortiManager(addresses=args.addresses, policies=args.policies, latency=args.latency) as server:
+        # Without single flight, so every request of the throughput benchmark reaches the server
+        with FortiManager(host=server.host, pool_maxsize=args.concurrency, single_flight=False) as fortimngr:
+            results = {
+                "requests": bench_requests(fortimngr, args.requests, args.concurrency),
+                "memory": bench_memory(fortimngr, args.page_size),
+                "push": bench_push(fortimngr, args.push, args.chunk_size),
+                "server_requests": server.requests,
+            }
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for section, values in results.items():
+        print(f"{section}: {json.dumps(values)}")
+
+
+if __name__ == "__main__":
+    main()
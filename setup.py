@@ -7,7 +7,7 @@ setup(
     name='pyFortiManagerAPI',
     description='A Python wrapper for the FortiManager REST API',
     version='0.1',
-    py_modules=["pyFortiManagerAPI"],
+    py_modules=["pyFortiManagerAPI", "pyFortiManagerMock"],
     package_dir={'': 'src'},
     keywords=['Fortimanager', 'RestAPI', 'API', 'Fortigate', 'Fortinet', "python", "Fortimanager Rest API",
               "Fortimanager Rest API Python", "Python examples"],
@@ -21,7 +21,7 @@ setup(
     long_description=long_description,
     long_description_content_type="text/markdown",
     install_requires=['requests', 'urllib3'],
-    extra_require={"dev": ["pytest>=3.7"]},
+    extras_require={"dev": ["pytest>=3.7"], "async": ["aiohttp>=3.6"], "fast": ["orjson"]},
     url="https://github.com/akshaymane920/pyFortiManagerAPI",
     author="Akshay Mane",
     author_email="akshaymane920@gmail.com",
@@ -1,58 +1,776 @@
 __author__ = "Akshay Mane"
 
+import asyncio
+import bisect
+import contextlib
+import copy
+import csv
+import fnmatch
+import functools
+import hashlib
+import ipaddress
+import json
+import logging
+import mmap
+import os
+import random
+import re
+import socket
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
 import urllib3
+from requests.adapters import HTTPAdapter
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # Disable insecure connections warnings
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
+logger = logging.getLogger(__name__)
+
+# Status code FortiManager returns when the session id is unknown or has timed out
+SESSION_EXPIRED_CODE = -11
+
+# Urls whose content changes on its own and must never be served from the cache
+VOLATILE_URLS = re.compile(r"^/?(task/|dvmdb/adom/[^/]+/device)")
+
+# JSON-RPC methods that give the same outcome when sent twice, and may be retried after any transient failure.
+# Other methods are only retried when the connection could not be opened, so the request never reached FortiManager
+IDEMPOTENT_METHODS = ("get", "set", "update")
+
+# HTTP statuses meaning FortiManager or a proxy in front of it is overloaded or restarting
+RETRY_HTTP_STATUSES = (429, 502, 503, 504)
+
+# Keyword arguments of FortiManager.make_data() and the FortiManager attributes they stand for
+OBJECT_MAPS = \
+    {
+        "allow_routing": "allow-routing",
+        "associated_interface": "associated-interface",
+        "comment": "comment",
+        "object_name": "name",
+        "subnet": "subnet",
+        "object_type": "type"
+    }
+POLICY_MAPS = \
+    {
+        "name": "name",
+        "source_interface": "srcintf",
+        "source_address": "srcaddr",
+        "destination_interface": "dstintf",
+        "destination_address": "dstaddr",
+        "service": "service",
+        "schedule": "schedule",
+        "action": "action",
+        "logtraffic": "logtraffic",
+        "comment": "comments"
+    }
+
+_json_encoder = json.JSONEncoder(separators=(",", ":"), ensure_ascii=False)
+
+
+def json_dumps(obj):
+    """
+    Encode obj as compact JSON, using orjson when it is installed
+    :return: bytes
+    """
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return _json_encoder.encode(obj).encode("utf-8")
+
+
+def json_loads(data):
+    """
+    Decode a JSON document, using orjson when it is installed
+    :param data: bytes or str
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _unreachable(error):
+    """
+    True when a requests exception means the connection to FortiManager was never opened,
+    so the request cannot have reached it
+    """
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(error, requests.exceptions.ConnectTimeout) or \
+        isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+
+@functools.lru_cache(maxsize=1024)
+def _request_prefix(method, url):
+    """
+    Encoded start of a single-call request up to and including its url, shared by every call
+    to the same method and url
+    :return: bytes
+    """
+    return b'{"method":' + json_dumps(method) + b',"params":[{"url":' + json_dumps(url)
+
+
+def _request_template(payload):
+    """
+    Encode everything of a JSON-RPC request except the session id, which changes on login.
+    The method and url of a single call come from a cache, so only the per-call options are encoded.
+    Complete it with _request_body() so a resend after login does not encode the params again.
+    :param payload: JSON-RPC request with "method" and "params"
+    :return: bytes
+    """
+    params = payload["params"]
+    if len(params) == 1 and isinstance(params[0], dict) and isinstance(params[0].get("url"), str):
+        options = {key: value for key, value in params[0].items() if key != "url"}
+        return _request_prefix(payload["method"], params[0]["url"]) + \
+            (b"," + json_dumps(options)[1:] if options else b"}") + b'],"session":'
+    return b'{"method":' + json_dumps(payload["method"]) + b',"params":' + json_dumps(params) + \
+        b',"session":'
+
+
+def _request_body(template, sessionid):
+    return template + json_dumps(sessionid) + b"}"
+
+
+class FortiManagerError(Exception):
+    """
+    Raised when FortiManager answers a request with a non zero status code
+    """
+
+    def __init__(self, code, message, url=None):
+        super().__init__(f"{url}: {message} (code {code})" if url else f"{message} (code {code})")
+        self.code = code
+        self.message = message
+        self.url = url
+
+    @classmethod
+    def check(cls, result):
+        """
+        Raise for the first entry of a JSON-RPC result that has a non zero status code
+        :param result: Response of status code with data in JSON Format
+        :return: The result itself when every status code is 0
+        """
+        for entry in result:
+            status = entry.get("status", {})
+            if status.get("code", 0) != 0:
+                raise cls(status.get("code"), status.get("message"), entry.get("url"))
+        return result
+
+
+class Filter:
+    """
+    Server side filter expression for the get methods.
+    Build one from Field comparisons and combine them with & (and) and | (or).
+
+    >>> Field("name").like("LAN_%") & (Field("type") == 0)
+    """
+
+    def __init__(self, expression):
+        self.expression = expression
+
+    def __and__(self, other):
+        return Filter([self.expression, "&&", _filter_expression(other)])
+
+    def __or__(self, other):
+        return Filter([self.expression, "||", _filter_expression(other)])
+
+    def __repr__(self):
+        return f"Filter({self.expression!r})"
+
+
+class Field:
+    """
+    Attribute of a FortiManager entry, used to build a Filter
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def _compare(self, operator, *values):
+        return Filter([self.name, operator, *values])
+
+    def __eq__(self, value):
+        return self._compare("==", value)
+
+    def __ne__(self, value):
+        return self._compare("!=", value)
+
+    def __lt__(self, value):
+        return self._compare("<", value)
+
+    def __le__(self, value):
+        return self._compare("<=", value)
+
+    def __gt__(self, value):
+        return self._compare(">", value)
+
+    def __ge__(self, value):
+        return self._compare(">=", value)
+
+    __hash__ = None
+
+    def like(self, pattern):
+        """
+        SQL like match, "%" matches any sequence of characters
+        """
+        return self._compare("like", pattern)
+
+    def contain(self, value):
+        """
+        Match entries whose list attribute contains the value eg. Field("member").contain("HOST_1")
+        """
+        return self._compare("contain", value)
+
+    def in_(self, *values):
+        return self._compare("in", *values)
+
+
+def _filter_expression(value):
+    return value.expression if isinstance(value, Filter) else value
+
+
+def _request_options(fields=None, filter=None, sortings=None):
+    """
+    Translate the fields, filter and sortings arguments of the get methods into JSON-RPC request options
+    """
+    options = {}
+    if fields:
+        options["fields"] = list(fields)
+    if filter is not None:
+        options["filter"] = _filter_expression(filter)
+    if sortings:
+        options["sortings"] = [
+            sorting if isinstance(sorting, dict) else
+            {sorting[1:]: -1} if sorting.startswith("-") else {sorting: 1}
+            for sorting in sortings
+        ]
+    return options
+
+
+class ObjectCache:
+    """
+    Read-through cache for the results of single-url "get" requests, with a TTL and LRU eviction.
+
+    Entries are keyed by url and request options. A write to a url drops the cached entries of that url,
+    of everything below it and of every table above it, eg. updating ".../firewall/address/HOST_1" drops
+    ".../firewall/address/HOST_1" and the ".../firewall/address" listing.
+    Pages read with the "range" option are not cached, so iterating over a table does not fill the cache.
+    """
+
+    def __init__(self, ttl=60, maxsize=1024):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        # Increased by every invalidation, so that a read started before a write is not cached after it
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def _key(payload):
+        params = payload["params"]
+        if payload["method"] != "get" or len(params) != 1 or VOLATILE_URLS.match(params[0]["url"]) or \
+                "range" in params[0]:
+            return None
+        options = tuple(sorted((key, json_dumps(value)) for key, value in params[0].items() if key != "url"))
+        return params[0]["url"].rstrip("/"), options
+
+    def get(self, payload):
+        """
+        :param payload: JSON-RPC request
+        :return: A copy of the cached result, or None on a miss
+        """
+        key = self._key(payload)
+        if key is None:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return copy.deepcopy(entry[1])
+
+    def put(self, payload, result, generation=None):
+        """
+        Cache the result of a successful get request
+        :param generation: Value of generation when the request was sent. The result is dropped when an
+                           invalidation happened since
+        """
+        key = self._key(payload)
+        if key is None or any(entry.get("status", {}).get("code", 0) != 0 for entry in result):
+            return
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._entries[key] = (time.monotonic() + self.ttl, copy.deepcopy(result))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, url):
+        """
+        Drop the entries of the url, of the urls below it and of the tables above it
+        :param url: FortiManager url that has been written
+        """
+        url = url.rstrip("/")
+        parents = set()
+        parent = url
+        while "/" in parent:
+            parent = parent.rsplit("/", 1)[0]
+            parents.add(parent)
+        with self._lock:
+            self.generation += 1
+            for key in [key for key in self._entries
+                        if key[0] == url or key[0].startswith(url + "/") or key[0] in parents]:
+                del self._entries[key]
+                self.invalidations += 1
+
+    def clear(self, adom=None):
+        """
+        Drop every entry, or only the entries of one adom
+        :param adom: Name of the adom to clear
+        """
+        with self._lock:
+            self.generation += 1
+            if adom is None:
+                self._entries.clear()
+                return
+            pattern = re.compile(rf"(^|/)adom/{re.escape(adom)}(/|$)")
+            for key in [key for key in self._entries if pattern.search(key[0])]:
+                del self._entries[key]
+
+    def stats(self):
+        """
+        :return: Dictionary with hits, misses, hit_ratio, evictions, invalidations and size
+        """
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "size": len(self._entries),
+        }
+
+
+class SingleFlight:
+    """
+    Lets concurrent identical calls share one execution: the first caller of a key runs the call, the callers
+    arriving while it is in flight wait for it and receive a copy of its result, or its exception.
+    """
+
+    def __init__(self):
+        self.shared = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._calls)
+
+    def do(self, key, function):
+        """
+        :param key: Hashable identity of the call
+        :param function: Callable running the call
+        :return: Result of function
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                # [done event, result, exception, number of followers]
+                call = self._calls[key] = [threading.Event(), None, None, 0]
+            else:
+                call[3] += 1
+                self.shared += 1
+        if not leader:
+            call[0].wait()
+            if call[2] is not None:
+                raise call[2]
+            return copy.deepcopy(call[1])
+        result = None
+        try:
+            result = function()
+            return result
+        except BaseException as error:
+            call[2] = error
+            raise
+        finally:
+            with self._lock:
+                if self._calls.get(key) is call:
+                    del self._calls[key]
+                followers = call[3]
+            # No follower can join anymore. Those waiting copy this snapshot, so the leader's caller can change its
+            # own result freely, and a call nobody joined pays no copy
+            if followers and call[2] is None:
+                call[1] = copy.deepcopy(result)
+            call[0].set()
+
+    def forget(self):
+        """
+        Make the next callers start new executions instead of joining the ones in flight, eg. after a write
+        """
+        with self._lock:
+            self._calls.clear()
+
+
+class TokenBucket:
+    """
+    Rate limiter allowing rate requests per second on average, with bursts of up to burst requests
+    """
+
+    def __init__(self, rate, burst=None):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = rate
+        self.burst = burst or max(1, int(rate))
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Wait until a request may be sent
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    Limit the number of requests in flight with additive increase, multiplicative decrease (AIMD).
+
+    The limit grows by about one per round of successful requests, and is multiplied by backoff when a request
+    fails, is answered with an overload HTTP status, or takes longer than latency_target seconds.
+    """
+
+    def __init__(self, initial=8, minimum=1, maximum=64, latency_target=None, backoff=0.5):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_target = latency_target
+        self.backoff = backoff
+        self.in_flight = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """
+        Wait until fewer requests than the current limit are in flight
+        """
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+
+    def release(self, latency, ok=True):
+        """
+        Record the outcome of a request and adjust the limit
+        :param latency: Seconds the request took
+        :param ok: False when the request failed or FortiManager reported being overloaded
+        """
+        with self._condition:
+            self.in_flight -= 1
+            if not ok or (self.latency_target is not None and latency > self.latency_target):
+                self.limit = max(self.minimum, self.limit * self.backoff)
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+
+class RequestEvent:
+    """
+    What happened to one request sent to FortiManager, passed to the hooks of FortiManager.add_hook().
+
+    "timings" holds the seconds spent in each phase: "encode", "login", "network" (sending and waiting for the
+    answer), "decode" and "total". A resend after an expired session adds to the same phases.
+    """
+
+    def __init__(self, payload):
+        self.method = payload["method"]
+        self.params = payload["params"]
+        self.urls = [params.get("url") for params in payload["params"]]
+        self.timings = {}
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.http_status = None
+        self.relogin = False
+        self.retries = 0
+        self.result = None
+        self.error = None
+        self._start = time.perf_counter()
+
+    @contextlib.contextmanager
+    def timing(self, phase):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[phase] = self.timings.get(phase, 0.0) + time.perf_counter() - start
+
+    def finish(self):
+        self.timings["total"] = time.perf_counter() - self._start
+
+    @property
+    def status_code(self):
+        """
+        First non zero status code of the result, 0 when every operation succeeded, None when there is no result
+        """
+        if self.result is None:
+            return None
+        for entry in self.result:
+            code = entry.get("status", {}).get("code", 0)
+            if code != 0:
+                return code
+        return 0
+
+    def __repr__(self):
+        return f"RequestEvent(method={self.method!r}, urls={self.urls!r}, status_code={self.status_code!r}, " \
+               f"total={self.timings.get('total', 0.0):.6f})"
+
+
+class MetricsCollector:
+    """
+    In-memory request metrics fed by FortiManager hooks: request counters by method and status code, byte counters,
+    and latency histograms by method and phase. Export them with to_prometheus().
+
+    >>> metrics = MetricsCollector()
+    >>> fortimngr.add_hook(metrics)
+    >>> print(metrics.to_prometheus())
+    """
+
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, prefix="fortimanager"):
+        self.buckets = tuple(sorted(buckets))
+        self.prefix = prefix
+        self.requests = {}
+        self.errors = {}
+        self.relogins = 0
+        self.request_bytes = 0
+        self.response_bytes = 0
+        # (method, phase) -> [bucket counts..., +Inf count, sum]
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        code = "error" if event.error is not None else str(event.status_code)
+        with self._lock:
+            key = (event.method, code)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            if event.error is not None:
+                name = type(event.error).__name__
+                self.errors[name] = self.errors.get(name, 0) + 1
+            self.relogins += event.relogin
+            self.request_bytes += event.request_bytes
+            self.response_bytes += event.response_bytes
+            for phase, seconds in event.timings.items():
+                histogram = self.histograms.setdefault((event.method, phase), [0] * (len(self.buckets) + 2))
+                for index, bound in enumerate(self.buckets):
+                    if seconds <= bound:
+                        histogram[index] += 1
+                histogram[-2] += 1
+                histogram[-1] += seconds
+
+    def reset(self):
+        with self._lock:
+            self.requests.clear()
+            self.errors.clear()
+            self.histograms.clear()
+            self.relogins = self.request_bytes = self.response_bytes = 0
+
+    def quantile(self, method, phase, fraction):
+        """
+        Estimate a latency quantile from a histogram, as the upper bound of the bucket holding it
+        :return: Seconds, or None when nothing has been recorded
+        """
+        with self._lock:
+            histogram = self.histograms.get((method, phase))
+            if not histogram or not histogram[-2]:
+                return None
+            rank = fraction * histogram[-2]
+            for bound, count in zip(self.buckets, histogram):
+                if count >= rank:
+                    return bound
+            return float("inf")
+
+    def to_prometheus(self):
+        """
+        :return: The metrics in the Prometheus text exposition format
+        """
+        name = self.prefix
+        lines = []
+        with self._lock:
+            lines += [f"# HELP {name}_requests_total Requests sent to FortiManager.",
+                      f"# TYPE {name}_requests_total counter"]
+            lines += [f'{name}_requests_total{{method="{method}",code="{code}"}} {count}'
+                      for (method, code), count in sorted(self.requests.items())]
+            lines += [f"# HELP {name}_request_exceptions_total Requests that raised instead of returning a result.",
+                      f"# TYPE {name}_request_exceptions_total counter"]
+            lines += [f'{name}_request_exceptions_total{{exception="{error}"}} {count}'
+                      for error, count in sorted(self.errors.items())]
+            for metric, value, text in (("relogins_total", self.relogins, "Logins caused by expired sessions."),
+                                        ("request_bytes_total", self.request_bytes, "Bytes of request bodies."),
+                                        ("response_bytes_total", self.response_bytes, "Bytes of response bodies.")):
+                lines += [f"# HELP {name}_{metric} {text}", f"# TYPE {name}_{metric} counter",
+                          f"{name}_{metric} {value}"]
+            lines += [f"# HELP {name}_request_duration_seconds Time spent per request phase.",
+                      f"# TYPE {name}_request_duration_seconds histogram"]
+            for (method, phase), histogram in sorted(self.histograms.items()):
+                labels = f'method="{method}",phase="{phase}"'
+                lines += [f'{name}_request_duration_seconds_bucket{{{labels},le="{bound}"}} {count}'
+                          for bound, count in zip(self.buckets, histogram)]
+                lines += [f'{name}_request_duration_seconds_bucket{{{labels},le="+Inf"}} {histogram[-2]}',
+                          f"{name}_request_duration_seconds_sum{{{labels}}} {histogram[-1]}",
+                          f"{name}_request_duration_seconds_count{{{labels}}} {histogram[-2]}"]
+        return "\n".join(lines) + "\n"
+
+
+class FanOutResult:
+    """
+    Results of FortiManager.fan_out(). "results" and "errors" are keyed by adom name,
+    or by (appliance, adom) for FortiManagerFleet.fan_out().
+    """
+
+    def __init__(self):
+        self.results = {}
+        self.errors = {}
+
+    @property
+    def ok(self):
+        return not self.errors
+
+    def __repr__(self):
+        return f"FanOutResult(results={sorted(self.results)!r}, errors={sorted(self.errors)!r})"
+
 
 class FortiManager:
-    def __init__(self, host, username="admin", password="admin", adom="root", verify=False):
+    def __init__(self, host, username="admin", password="admin", adom="root", verify=False, pool_maxsize=10,
+                 cache_ttl=None, cache_size=1024, timeout=None, rate_limit=None, concurrency_limiter=None,
+                 max_retries=3, backoff_factor=0.5, max_backoff=30, single_flight=True):
         protocol = "https"
         self.host = host
         self.username = username
         self.password = password
         self.adom = adom
-        self.sessionid = "null"
         self.verify = verify
+        self.pool_maxsize = pool_maxsize
+        self.timeout = timeout
+        self.rate_limiter = TokenBucket(rate_limit) if rate_limit else None
+        self.concurrency_limiter = concurrency_limiter
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
         if not self.verify:
             protocol = "http"
         self.base_url = f"{protocol}://{self.host}/jsonrpc"
+        # Login state lives in a dict so that the views returned by for_adom() share it with this instance
+        self._shared = {"sessionid": "null", "session": None}
+        self._login_lock = threading.Lock()
+        self.cache = ObjectCache(ttl=cache_ttl, maxsize=cache_size) if cache_ttl else None
+        self.single_flight = SingleFlight() if single_flight else None
+        self.hooks = []
 
-    # Login Method
-    def login(self):
+    @property
+    def sessionid(self):
+        return self._shared["sessionid"]
+
+    @sessionid.setter
+    def sessionid(self, value):
+        self._shared["sessionid"] = value
+
+    @property
+    def _session(self):
+        return self._shared["session"]
+
+    @_session.setter
+    def _session(self, value):
+        self._shared["session"] = value
+
+    def __enter__(self):
+        self.login()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _new_session(self):
         """
-        Log in to FortiManager with the details provided during object creation of this class
+        Build the HTTP session shared by all calls, with a keep-alive connection pool of pool_maxsize connections
         :return: Session
         """
         session = requests.session()
-        payload = \
-            {
-                "method": "exec",
-                "params":
-                    [
-                        {
-                            "data": {
-                                "passwd": self.password,
-                                "user": self.username
-                            },
-                            "url": "sys/login/user"
-                        }
-                    ],
-                "session": self.sessionid
-            }
-        payload = repr(payload)
-        login = session.post(url=self.base_url, data=payload, verify=self.verify)
-        self.sessionid = login.json()['session']
+        session.headers["Content-Type"] = "application/json"
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_maxsize)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
         return session
 
+    # Login Method
+    def login(self):
+        """
+        Log in to FortiManager with the details provided during object creation of this class.
+        The session is kept alive and reused by all calls until logout() or close() is called.
+        :return: Session
+        """
+        with self._login_lock:
+            if self._session is None:
+                self._session = self._new_session()
+            if self.sessionid == "null":
+                payload = \
+                    {
+                        "method": "exec",
+                        "params":
+                            [
+                                {
+                                    "data": {
+                                        "passwd": self.password,
+                                        "user": self.username
+                                    },
+                                    "url": "sys/login/user"
+                                }
+                            ],
+                        "session": self.sessionid
+                    }
+                login = self._session.post(url=self.base_url, data=json_dumps(payload), verify=self.verify,
+                                           timeout=self.timeout)
+                self.sessionid = json_loads(login.content)['session']
+            return self._session
+
     def logout(self):
         """
         Logout from FortiManager
         :return: Response of status code with data in JSON Format
         """
-        session = requests.session()
+        session = self._session or self._new_session()
         payload = \
             {
                 "method": "exec",
@@ -64,21 +782,266 @@ class FortiManager:
                     ],
                 "session": self.sessionid
             }
-        payload = repr(payload)
-        logout = session.post(url=self.base_url, data=payload, verify=self.verify)
-        return logout.json()["result"]
+        logout = session.post(url=self.base_url, data=json_dumps(payload), verify=self.verify, timeout=self.timeout)
+        self.sessionid = "null"
+        return json_loads(logout.content)["result"]
+
+    def close(self):
+        """
+        Logout if a session is open and release the pooled connections
+        """
+        if self._session is None:
+            return
+        if self.sessionid != "null":
+            self.logout()
+        self._session.close()
+        self._session = None
+
+    def _relogin(self, stale_sessionid):
+        """
+        Drop an expired session id and log in again. Only the first caller holding the stale id logs in,
+        concurrent callers pick up the fresh session.
+        :param stale_sessionid: Session id that FortiManager rejected
+        :return: Session
+        """
+        with self._login_lock:
+            if self.sessionid == stale_sessionid:
+                self.sessionid = "null"
+        return self.login()
+
+    @staticmethod
+    def _session_expired(result):
+        try:
+            return result[0]["status"]["code"] == SESSION_EXPIRED_CODE
+        except (KeyError, IndexError, TypeError):
+            return False
+
+    def _post(self, payload):
+        """
+        Send a JSON-RPC payload, answering get requests from the cache when it is enabled
+        and dropping the cached entries touched by any other request.
+        Identical get requests sent at the same time by several threads share a single request.
+        :param payload: JSON-RPC request with "method" and "params"
+        :return: Response of status code with data in JSON Format
+        """
+        if payload["method"] == "get":
+            result = self.cache.get(payload) if self.cache is not None else None
+            if result is None:
+                generation = self.cache.generation if self.cache is not None else None
+                result = self._read(payload)
+                if self.cache is not None:
+                    self.cache.put(payload, result, generation)
+            return result
+        result = self._call(payload)
+        if self.single_flight is not None:
+            self.single_flight.forget()
+        if self.cache is not None:
+            for params in payload["params"]:
+                self.cache.invalidate(params["url"])
+        return result
+
+    def _read(self, payload):
+        if self.single_flight is None:
+            return self._call(payload)
+        key = json_dumps(payload["params"])
+        return self.single_flight.do(key, lambda: self._call(payload))
+
+    def add_hook(self, hook):
+        """
+        Call hook with a RequestEvent after every request sent to FortiManager, eg. a MetricsCollector.
+        Requests answered from the cache are not sent and do not reach the hooks.
+        :param hook: Callable taking a RequestEvent
+        """
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def _call(self, payload):
+        """
+        Send a JSON-RPC payload over the persistent session.
+        If FortiManager reports that the session has expired, log in again and resend once.
+        :param payload: JSON-RPC request with "method" and "params"
+        :return: Response of status code with data in JSON Format
+        """
+        event = RequestEvent(payload)
+        try:
+            with event.timing("encode"):
+                template = _request_template(payload)
+            with event.timing("login"):
+                session = self.login()
+            sessionid = self.sessionid
+            result = self._send(session, template, sessionid, event)
+            if self._session_expired(result):
+                event.relogin = True
+                with event.timing("login"):
+                    session = self._relogin(sessionid)
+                result = self._send(session, template, self.sessionid, event)
+            event.result = result
+            return result
+        except Exception as error:
+            event.error = error
+            raise
+        finally:
+            event.finish()
+            for hook in self.hooks:
+                # A failing hook must not turn the outcome of the request into an error
+                try:
+                    hook(event)
+                except Exception:
+                    logger.exception("request hook %r failed", hook)
+
+    def for_adom(self, adom):
+        """
+        Get a view of this instance working on another adom.
+        The view shares the login session, the connection pool and the cache of this instance.
+        :param adom: Name of the adom
+        :return: FortiManager
+        """
+        view = copy.copy(self)
+        view.adom = adom
+        return view
+
+    def fan_out(self, method, adoms=None, max_workers=10, **kwargs):
+        """
+        Run the same read on many adoms concurrently over the shared session and connection pool.
+        Keep max_workers at or below pool_maxsize so that every worker gets a pooled connection.
+
+        :param method: Name of a FortiManager method eg. "get_firewall_address_objects",
+                       or a callable taking the per adom FortiManager view
+        :param adoms: Names of the adoms to query. Default is every adom returned by get_adoms()
+        :param max_workers: Number of adoms queried at the same time
+        :param kwargs: Keyword arguments passed to the method
+        :return: FanOutResult with the results and the errors keyed by adom
+        """
+        if adoms is None:
+            adoms = [adom["name"] for adom in FortiManagerError.check(self.get_adoms(fields=["name"]))[0]["data"]]
+
+        def run(adom):
+            view = self.for_adom(adom)
+            if callable(method):
+                return method(view, **kwargs)
+            return FortiManagerError.check(getattr(view, method)(**kwargs))
+
+        self.login()
+        outcome = FanOutResult()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {adom: executor.submit(run, adom) for adom in adoms}
+            for adom, future in futures.items():
+                try:
+                    outcome.results[adom] = future.result()
+                except Exception as error:
+                    outcome.errors[adom] = error
+        return outcome
+
+    def batch(self, chunk_size=100):
+        """
+        Queue many operations and send them as a few multi-param JSON-RPC requests
+        :param chunk_size: Maximum number of operations sent in a single request
+        :return: Batch object. Call its methods like you would on FortiManager, then execute() it
+        """
+        return Batch(self, chunk_size=chunk_size)
+
+    def _iter_table(self, url, page_size=1000, **options):
+        """
+        Yield the entries of a table page by page using the "range" option.
+        The next page is fetched in the background while the current one is consumed.
+        :param url: FortiManager url of the table
+        :param page_size: Number of entries requested per page
+        :param options: Other request options sent with every page
+        """
+        if page_size < 1:
+            raise ValueError("page_size must be at least 1")
+
+        def get_page(offset):
+            payload = \
+                {
+                    "method": "get",
+                    "params": [
+                        dict(options, url=url, range=[offset, page_size])
+                    ]
+                }
+            result = FortiManagerError.check(self._post(payload))
+            return result[0].get("data") or []
+
+        executor = ThreadPoolExecutor(max_workers=1)
+        try:
+            offset = 0
+            page = executor.submit(get_page, offset)
+            while page is not None:
+                entries = page.result()
+                offset += len(entries)
+                page = executor.submit(get_page, offset) if len(entries) == page_size else None
+                yield from entries
+        finally:
+            executor.shutdown(wait=False)
+
+    def _retryable(self, method, error):
+        if method in IDEMPOTENT_METHODS:
+            return True
+        return _unreachable(error)
+
+    def _backoff(self, attempt):
+        """
+        Seconds to wait before retry number attempt + 1: exponential backoff with full jitter
+        """
+        return random.uniform(0, min(self.max_backoff, self.backoff_factor * 2 ** attempt))
+
+    def _post_once(self, session, body, event):
+        """
+        Send one HTTP request through the rate and concurrency limiters
+        """
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+        if self.concurrency_limiter is None:
+            with event.timing("network"):
+                return session.post(url=self.base_url, data=body, verify=self.verify, timeout=self.timeout)
+        self.concurrency_limiter.acquire()
+        start, ok = time.perf_counter(), False
+        try:
+            with event.timing("network"):
+                response = session.post(url=self.base_url, data=body, verify=self.verify, timeout=self.timeout)
+            ok = response.status_code not in RETRY_HTTP_STATUSES
+            return response
+        finally:
+            self.concurrency_limiter.release(time.perf_counter() - start, ok)
+
+    def _send(self, session, template, sessionid, event):
+        body = _request_body(template, sessionid)
+        attempt = 0
+        while True:
+            try:
+                response = self._post_once(session, body, event)
+                if response.status_code in RETRY_HTTP_STATUSES and attempt < self.max_retries:
+                    raise requests.exceptions.HTTPError(f"HTTP {response.status_code}", response=response)
+                break
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                    requests.exceptions.HTTPError) as error:
+                if attempt >= self.max_retries or not self._retryable(event.method, error):
+                    raise
+            time.sleep(self._backoff(attempt))
+            attempt += 1
+            event.retries += 1
+        event.http_status = response.status_code
+        event.request_bytes += len(body)
+        event.response_bytes += len(response.content)
+        response.raise_for_status()
+        with event.timing("decode"):
+            return json_loads(response.content)["result"]
 
     # Adoms Methods
-    def get_adoms(self, name=False):
+    def get_adoms(self, name=False, fields=None, filter=None, sortings=None):
         """
         Get all adoms from the FortiManager
         :param name: Can get specific adom using name as a filter
+        :param fields: Only return these attributes                     eg. ["name", "state"]
+        :param filter: Only return matching entries, a Filter or a raw expression eg. ["name", "like", "EU_%"]
+        :param sortings: Sort by these attributes, prefix "-" for descending  eg. ["name"]
         :return: Response of status code with data in JSON Format
         """
         url = "dvmdb/adom"
         if name:
             url = f"dvmdb/adom/{name}"
-        session = self.login()
         payload = \
             {
                 "method": "get",
@@ -86,40 +1049,75 @@ class FortiManager:
                     [
                         {
                             "url": url,
-                            "option": "object member"
+                            "option": "object member",
+                            **_request_options(fields, filter, sortings)
                         }
-                    ],
-                "session": self.sessionid
+                    ]
+            }
+        return self._post(payload)
+
+    # Device Methods
+    def get_devices(self, name=False, fields=None, filter=None, sortings=None):
+        """
+        Get the devices managed in the adom
+        :param name: Can get specific device using name as a filter
+        :param fields: Only return these attributes                     eg. ["name", "conn_status"]
+        :param filter: Only return matching entries, a Filter or a raw expression eg. ["name", "like", "FGT-%"]
+        :param sortings: Sort by these attributes, prefix "-" for descending  eg. ["-name"]
+        :return: Response of status code with data in JSON Format
+        """
+        url = f"dvmdb/adom/{self.adom}/device"
+        if name:
+            url = f"dvmdb/adom/{self.adom}/device/{name}"
+        payload = \
+            {
+                "method": "get",
+                "params": [
+                    {
+                        "url": url,
+                        **_request_options(fields, filter, sortings)
+                    }
+                ]
             }
-        payload = repr(payload)
-        get_adoms = session.post(url=self.base_url, data=payload, verify=False)
-        return get_adoms.json()["result"]
+        return self._post(payload)
+
+    def iter_devices(self, page_size=1000, fields=None, filter=None, sortings=None):
+        """
+        Iterate over the devices managed in the adom without loading the whole table in memory
+        :param page_size: Number of devices fetched per request
+        :param fields: Only return these attributes                     eg. ["name", "conn_status"]
+        :param filter: Only return matching entries, a Filter or a raw expression eg. ["name", "like", "FGT-%"]
+        :param sortings: Sort by these attributes, prefix "-" for descending  eg. ["-name"]
+        :return: Generator of devices
+        """
+        return self._iter_table(f"dvmdb/adom/{self.adom}/device", page_size=page_size,
+                                **_request_options(fields, filter, sortings))
 
     # Policy Package Methods
-    def get_policy_packages(self, name=False):
+    def get_policy_packages(self, name=False, fields=None, filter=None, sortings=None):
         """
         Get all the policy packages configured on FortiManager
         :param name: Can get specific package using name as a filter
+        :param fields: Only return these attributes                     eg. ["name", "type"]
+        :param filter: Only return matching entries, a Filter or a raw expression eg. ["name", "like", "BRANCH_%"]
+        :param sortings: Sort by these attributes, prefix "-" for descending  eg. ["name"]
         :return: Response of status code with data in JSON Format
         """
         url = f"pm/pkg/adom/{self.adom}/"
         if name:
             url = f"pm/pkg/adom/{self.adom}/{name}"
-        session = self.login()
         payload = \
             {
                 "method": "get",
                 "params":
                     [
                         {
-                            "url": url
+                            "url": url,
+                            **_request_options(fields, filter, sortings)
                         }
-                    ],
-                "session": self.sessionid
+                    ]
             }
-        payload = repr(payload)
-        get_packages = session.post(url=self.base_url, data=payload, verify=False)
-        return get_packages.json()["result"]
+        return self._post(payload)
 
     def add_policy_package(self, name):
         """
@@ -128,7 +1126,6 @@ class FortiManager:
         :return: Response of status code with data in JSON Format
         """
         url = f"pm/pkg/adom/{self.adom}/"
-        session = self.login()
         payload = \
             {
                 "method": "set",
@@ -141,36 +1138,46 @@ class FortiManager:
                             }, ],
                             "url": url
                         }
-                    ],
-                "session": self.sessionid
+                    ]
             }
-        payload = repr(payload)
-        add_package = session.post(url=self.base_url, data=payload, verify=False)
-        return add_package.json()["result"]
+        return self._post(payload)
 
     # Firewall Object Methods
-    def get_firewall_address_objects(self, name=False):
+    def get_firewall_address_objects(self, name=False, fields=None, filter=None, sortings=None):
         """
         Get all the address objects data stored in FortiManager
+        :param name: Can get specific address object using name as a filter
+        :param fields: Only return these attributes                     eg. ["name", "subnet"]
+        :param filter: Only return matching entries, a Filter or a raw expression eg. ["name", "like", "LAN_%"]
+        :param sortings: Sort by these attributes, prefix "-" for descending  eg. ["-name"]
         :return: Response of status code with data in JSON Format
         """
         url = f"pm/config/adom/{self.adom}/obj/firewall/address"
         if name:
             url = f"pm/config/adom/{self.adom}/obj/firewall/address/{name}"
-        session = self.login()
         payload = \
             {
                 "method": "get",
                 "params": [
                     {
-                        "url": url
+                        "url": url,
+                        **_request_options(fields, filter, sortings)
                     }
-                ],
-                "session": self.sessionid
+                ]
             }
-        payload = repr(payload)
-        get_address_objects = session.post(url=self.base_url, data=payload, verify=self.verify)
-        return get_address_objects.json()["result"]
+        return self._post(payload)
+
+    def iter_firewall_address_objects(self, page_size=1000, fields=None, filter=None, sortings=None):
+        """
+        Iterate over all the address objects without loading the whole table in memory
+        :param page_size: Number of objects fetched per request
+        :param fields: Only return these attributes                     eg. ["name", "subnet"]
+        :param filter: Only return matching entries, a Filter or a raw expression eg. ["name", "like", "LAN_%"]
+        :param sortings: Sort by these attributes, prefix "-" for descending  eg. ["-name"]
+        :return: Generator of address objects
+        """
+        return self._iter_table(f"pm/config/adom/{self.adom}/obj/firewall/address", page_size=page_size,
+                                **_request_options(fields, filter, sortings))
 
     def add_firewall_address_object(self, name, associated_interface="any", subnet=list, object_type=0,
                                     allow_routing=0):
@@ -183,7 +1190,6 @@ class FortiManager:
         :param allow_routing: Set routing if needed
         :return: Response of status code with data in JSON Format
         """
-        session = self.login()
         payload = {
             "method": "add",
             "params": [
@@ -197,12 +1203,9 @@ class FortiManager:
                     },
                     "url": f"pm/config/adom/{self.adom}/obj/firewall/address"
                 }
-            ],
-            "session": self.sessionid
+            ]
         }
-        payload = repr(payload)
-        add_address_objects = session.post(url=self.base_url, data=payload, verify=self.verify)
-        return add_address_objects.json()["result"]
+        return self._post(payload)
 
     def update_firewall_address_object(self, name, **data):
         """
@@ -213,7 +1216,6 @@ class FortiManager:
         :return: Response of status code with data in JSON Format
         """
         data = self.make_data(_for="object", **data)
-        session = self.login()
         payload = \
             {
                 "method": "update",
@@ -222,12 +1224,9 @@ class FortiManager:
                         "data": data,
                         "url": f"pm/config/adom/{self.adom}/obj/firewall/address/{name}"
                     }
-                ],
-                "session": self.sessionid
+                ]
             }
-        payload = repr(payload)
-        update_firewall_object = session.post(url=self.base_url, data=payload, verify=self.verify)
-        return update_firewall_object.json()["result"]
+        return self._post(payload)
 
     def delete_firewall_address_object(self, object_name):
         """
@@ -236,7 +1235,6 @@ class FortiManager:
         :param object_name: Enter the Object name you want to delete
         :return: Response of status code with data in JSON Format
         """
-        session = self.login()
         payload = \
             {
                 "method": "delete",
@@ -244,21 +1242,20 @@ class FortiManager:
                     {
                         "url": f"pm/config/adom/{self.adom}/obj/firewall/address/{object_name}"
                     }
-                ],
-                "session": self.sessionid
+                ]
             }
-        payload = repr(payload)
-        delete_address_object = session.post(url=self.base_url, data=payload, verify=self.verify)
-        return delete_address_object.json()["result"]
+        return self._post(payload)
 
     # Firewall Address Groups Methods
-    def get_address_groups(self, name=False):
+    def get_address_groups(self, name=False, fields=None, filter=None, sortings=None):
         """
         Get the address groups created in your FortiManager
         :param name: You can filter out the specific address group which you want to see
+        :param fields: Only return these attributes                     eg. ["name", "member"]
+        :param filter: Only return matching entries, a Filter or a raw expression eg. ["name", "like", "GRP_%"]
+        :param sortings: Sort by these attributes, prefix "-" for descending  eg. ["-name"]
         :return: Response of status code with data in JSON Format
         """
-        session = self.login()
         url = f"pm/config/adom/{self.adom}/obj/firewall/addrgrp"
         if name:
             url = f"pm/config/adom/{self.adom}/obj/firewall/addrgrp/{name}"
@@ -267,14 +1264,24 @@ class FortiManager:
                 "method": "get",
                 "params": [
                     {
-                        "url": url
+                        "url": url,
+                        **_request_options(fields, filter, sortings)
                     }
-                ],
-                "session": self.sessionid
+                ]
             }
-        payload = repr(payload)
-        get_address_group = session.post(url=self.base_url, data=payload, verify=self.verify)
-        return get_address_group.json()["result"]
+        return self._post(payload)
+
+    def iter_address_groups(self, page_size=1000, fields=None, filter=None, sortings=None):
+        """
+        Iterate over all the address groups without loading the whole table in memory
+        :param page_size: Number of groups fetched per request
+        :param fields: Only return these attributes                     eg. ["name", "member"]
+        :param filter: Only return matching entries, a Filter or a raw expression eg. ["name", "like", "GRP_%"]
+        :param sortings: Sort by these attributes, prefix "-" for descending  eg. ["-name"]
+        :return: Generator of address groups
+        """
+        return self._iter_table(f"pm/config/adom/{self.adom}/obj/firewall/addrgrp", page_size=page_size,
+                                **_request_options(fields, filter, sortings))
 
     def add_address_group(self, name, members=list):
         """
@@ -283,7 +1290,6 @@ class FortiManager:
         :param members: pass your object names as members in a list     eg. ["LAN_10.1.1.0_24, "INTERNET"]
         :return: Response of status code with data in JSON Format
         """
-        session = self.login()
         payload = \
             {
                 "method": "add",
@@ -295,55 +1301,91 @@ class FortiManager:
                         },
                         "url": f"pm/config/adom/{self.adom}/obj/firewall/addrgrp"
                     }
-                ],
-                "session": self.sessionid
+                ]
             }
-        payload = repr(payload)
-        add_address_group = session.post(url=self.base_url, data=payload, verify=self.verify)
-        return add_address_group.json()["result"]
+        return self._post(payload)
 
-    def update_address_group(self, name, object_name, do="add"):
+    def update_address_group(self, name, object_name, do="add", member_ops=True):
         """
-        Update Members of the Address group
+        Update Members of the Address group.
+        The object is added to or removed from the member list on FortiManager itself, so the group is not
+        read first and concurrent edits of other members are kept.
         :param name: Specify the name of the Address group you want to update
         :param object_name: Specify name of the object you wish to update(add/remove) in Members List
         :param do: Specify if you want to add or remove the object from the members list
                     do="add"    will add the object in the address group
                     do="remove" will remove the object from address group
+        :param member_ops: Set it to False for FortiManager versions without member level operations: the group
+                           is then read with one request and its new member list written back with one update.
+                           Not available on batches and AsyncFortiManager, which cannot read before writing
         :return: Response of status code with data in JSON Format
         """
-        session = self.login()
-        get_addr_group = self.get_address_groups(name=name)
-        members = get_addr_group[0]['data']['member']
-        if do == "add":
-            members.append(object_name)
-        elif do == "remove":
-            members.remove(object_name)
-
+        methods = {"add": "add", "remove": "delete"}
+        if do not in methods:
+            raise ValueError(f'do must be "add" or "remove", not {do!r}')
+        if not member_ops:
+            update_members = getattr(self, "update_address_group_members", None)
+            if update_members is None:
+                raise ValueError("member_ops=False needs to read the group first, use FortiManager instead")
+            return update_members({name: {do: [object_name]}}, member_ops=False)[name]
         payload = \
             {
-                "method": "update",
+                "method": methods[do],
                 "params": [
                     {
-                        "data": {
-                            "member": members,
-                        },
-                        "url": f"pm/config/adom/{self.adom}/obj/firewall/addrgrp/{name}"
+                        "data": [object_name],
+                        "url": f"pm/config/adom/{self.adom}/obj/firewall/addrgrp/{name}/member"
                     }
-                ],
-                "session": self.sessionid
+                ]
             }
-        payload = repr(payload)
-        update_address_group = session.post(url=self.base_url, data=payload, verify=False)
-        return update_address_group.json()["result"]
+        return self._post(payload)
 
-    def delete_address_group(self, name):
+    def update_address_group_members(self, changes, member_ops=True, chunk_size=100):
+        """
+        Add and remove many members of many address groups at once
+
+        :param changes: Members to add and remove per group
+                        eg. {"Test_Group": {"add": ["TestObject1", "TestObject2"], "remove": ["TestObject3"]}}
+        :param member_ops: Edit the member lists on FortiManager with member level add/delete operations.
+                           Set it to False for FortiManager versions without them: the groups are then read with
+                           one request and their new member lists written back with one batched update
+        :param chunk_size: Maximum number of operations sent in a single request
+        :return: Dictionary of group name to the results of its operations
+        """
+        batch = self.batch(chunk_size=chunk_size)
+        calls = {}
+        if member_ops:
+            # Queue every addition before every removal so that each kind goes out in as few requests as possible
+            for do, method in (("add", "add"), ("remove", "delete")):
+                for name, change in changes.items():
+                    calls.setdefault(name, [])
+                    if change.get(do):
+                        calls[name].append(batch.queue(
+                            method, f"pm/config/adom/{self.adom}/obj/firewall/addrgrp/{name}/member",
+                            data=list(change[do])))
+        else:
+            reads = self.batch(chunk_size=chunk_size)
+            groups = {name: reads.get_address_groups(name=name, fields=["member"]) for name in changes}
+            reads.execute()
+            for name, change in changes.items():
+                members = FortiManagerError.check(groups[name].result)[0]["data"].get("member") or []
+                members = [members] if isinstance(members, str) else members
+                removed = set(change.get("remove") or [])
+                members = [member for member in members if member not in removed]
+                for member in change.get("add") or []:
+                    if member not in members:
+                        members.append(member)
+                calls[name] = [batch.queue("update", f"pm/config/adom/{self.adom}/obj/firewall/addrgrp/{name}",
+                                           data={"member": members})]
+        batch.execute()
+        return {name: [entry for call in group_calls for entry in call.result] for name, group_calls in calls.items()}
+
+    def delete_address_group(self, name):
         """
         Delete the Address group if no longer needed
         :param name: Specify the name of the address you wish to delete
         :return: Response of status code with data in JSON Format
         """
-        session = self.login()
         payload = \
             {
                 "method": "delete",
@@ -353,38 +1395,100 @@ class FortiManager:
                         },
                         "url": f"pm/config/adom/{self.adom}/obj/firewall/addrgrp/{name}"
                     }
-                ],
-                "session": self.sessionid
+                ]
+            }
+        return self._post(payload)
+
+    # Firewall Service Methods
+    def get_firewall_services(self, name=False, fields=None, filter=None, sortings=None):
+        """
+        Get the custom services created in your FortiManager
+        :param name: Can get specific service using name as a filter
+        :param fields: Only return these attributes                     eg. ["name", "tcp-portrange"]
+        :param filter: Only return matching entries, a Filter or a raw expression eg. ["name", "like", "HTTP%"]
+        :param sortings: Sort by these attributes, prefix "-" for descending  eg. ["name"]
+        :return: Response of status code with data in JSON Format
+        """
+        url = f"pm/config/adom/{self.adom}/obj/firewall/service/custom"
+        if name:
+            url = f"pm/config/adom/{self.adom}/obj/firewall/service/custom/{name}"
+        payload = \
+            {
+                "method": "get",
+                "params": [
+                    {
+                        "url": url,
+                        **_request_options(fields, filter, sortings)
+                    }
+                ]
+            }
+        return self._post(payload)
+
+    def get_service_groups(self, name=False, fields=None, filter=None, sortings=None):
+        """
+        Get the service groups created in your FortiManager
+        :param name: Can get specific service group using name as a filter
+        :param fields: Only return these attributes                     eg. ["name", "member"]
+        :param filter: Only return matching entries, a Filter or a raw expression eg. ["name", "like", "WEB_%"]
+        :param sortings: Sort by these attributes, prefix "-" for descending  eg. ["name"]
+        :return: Response of status code with data in JSON Format
+        """
+        url = f"pm/config/adom/{self.adom}/obj/firewall/service/group"
+        if name:
+            url = f"pm/config/adom/{self.adom}/obj/firewall/service/group/{name}"
+        payload = \
+            {
+                "method": "get",
+                "params": [
+                    {
+                        "url": url,
+                        **_request_options(fields, filter, sortings)
+                    }
+                ]
             }
-        payload = repr(payload)
-        delete_address_group = session.post(url=self.base_url, data=payload, verify=False)
-        return delete_address_group.json()["result"]
+        return self._post(payload)
 
     # Firewall Policies Methods
-    def get_firewall_policies(self, policy_package_name="default", policyid=False):
+    def get_firewall_policies(self, policy_package_name="default", policyid=False, fields=None, filter=None,
+                              sortings=None):
         """
         Get the firewall policies present in the policy package
 
         :param policy_package_name: Enter the policy package name
         :param policyid: Can filter and get the policy you want using policyID
+        :param fields: Only return these attributes                     eg. ["policyid", "name", "action"]
+        :param filter: Only return matching entries, a Filter or a raw expression eg. ["action", "==", 0]
+        :param sortings: Sort by these attributes, prefix "-" for descending  eg. ["-policyid"]
         :return: Response of status code with data in JSON Format
         """
         url = f"pm/config/adom/{self.adom}/pkg/{policy_package_name}/firewall/policy/"
         if policyid:
             url = url + str(policyid)
-        session = self.login()
         payload = {
             "method": "get",
             "params": [
                 {
-                    "url": url
+                    "url": url,
+                    **_request_options(fields, filter, sortings)
                 }
-            ],
-            "session": self.sessionid
+            ]
         }
-        payload = repr(payload)
-        get_firewall_policies = session.post(url=self.base_url, data=payload, verify=self.verify)
-        return get_firewall_policies.json()["result"]
+        return self._post(payload)
+
+    def iter_firewall_policies(self, policy_package_name="default", page_size=1000, fields=None, filter=None,
+                               sortings=None):
+        """
+        Iterate over the firewall policies of the policy package without loading the whole table in memory
+
+        :param policy_package_name: Enter the policy package name
+        :param page_size: Number of policies fetched per request
+        :param fields: Only return these attributes                     eg. ["policyid", "name", "action"]
+        :param filter: Only return matching entries, a Filter or a raw expression eg. ["action", "==", 0]
+        :param sortings: Sort by these attributes, prefix "-" for descending  eg. ["-policyid"]
+        :return: Generator of policies
+        """
+        return self._iter_table(f"pm/config/adom/{self.adom}/pkg/{policy_package_name}/firewall/policy/",
+                                page_size=page_size, **_request_options(fields, filter, sortings))
 
     def add_firewall_policy(self, policy_package_name="default", name=str, source_interface=str,
                             source_address=str, destination_interface=str, destination_address=str,
@@ -407,7 +1511,6 @@ class FortiManager:
                             logtraffic=2 Means Log All Sessions
         :return: Response of status code with data in JSON Format
         """
-        session = self.login()
         payload = {
             "method": "add",
             "params": [
@@ -425,12 +1528,9 @@ class FortiManager:
                     },
                     "url": f"pm/config/adom/{self.adom}/pkg/{policy_package_name}/firewall/policy/"
                 }
-            ],
-            "session": self.sessionid
+            ]
         }
-        payload = repr(payload)
-        add_policy = session.post(url=self.base_url, data=payload, verify=self.verify)
-        return add_policy.json()["result"]
+        return self._post(payload)
 
     def update_firewall_policy(self, policy_package_name, policyid, **data):
         """
@@ -442,7 +1542,6 @@ class FortiManager:
         :return: Response of status code with data in JSON Format
         """
         data = self.make_data(**data)
-        session = self.login()
         payload = \
             {
                 "method": "update",
@@ -451,12 +1550,9 @@ class FortiManager:
                         "data": data,
                         "url": f"pm/config/adom/{self.adom}/pkg/{policy_package_name}/firewall/policy/{policyid}"
                     }
-                ],
-                "session": self.sessionid
+                ]
             }
-        payload = repr(payload)
-        update_policy = session.post(url=self.base_url, data=payload, verify=self.verify)
-        return update_policy.json()["result"]
+        return self._post(payload)
 
     def delete_firewall_policy(self, policy_package_name, policyid):
         """
@@ -466,7 +1562,6 @@ class FortiManager:
         :param policyid: Enter the policy ID of the policy you want to delete
         :return: Response of status code with data in JSON Format
         """
-        session = self.login()
         payload = \
             {
                 "method": "delete",
@@ -474,12 +1569,9 @@ class FortiManager:
                     {
                         "url": f"pm/config/adom/{self.adom}/pkg/{policy_package_name}/firewall/policy/{policyid}"
                     }
-                ],
-                "session": self.sessionid
+                ]
             }
-        payload = repr(payload)
-        delete_policy = session.post(url=self.base_url, data=payload, verify=self.verify)
-        return delete_policy.json()["result"]
+        return self._post(payload)
 
     def move_firewall_policy(self, policy_package_name, move_policyid=int, option="before", policyid=int):
         """
@@ -491,7 +1583,6 @@ class FortiManager:
         :param policyid: Specify the target policy
         :return: Response of status code with data in JSON Format
         """
-        session = self.login()
         payload = \
             {
                 "method": "move",
@@ -501,70 +1592,177 @@ class FortiManager:
                         "option": option,
                         "target": str(policyid)
                     }
-                ],
-                "session": self.sessionid
+                ]
             }
-        payload = repr(payload)
-        move_policy = session.post(url=self.base_url, data=payload, verify=self.verify)
-        return move_policy.json()["result"]
+        return self._post(payload)
+
+    def reorder_firewall_policies(self, policy_package_name, policyids, dry_run=False, chunk_size=100):
+        """
+        Put the policies of a package in the given order with as few moves as possible.
+        Policies that are already in order relative to each other are not moved, so reordering a few rules
+        of a large package costs about one move per displaced rule.
 
-    def install_policy_package(self, package_name):
+        :param policy_package_name: Enter the policy package name in which your policies belong
+        :param policyids: Policy IDs in the wanted order. Policies left out keep their place
+        :param dry_run: Only compute the moves
+        :param chunk_size: Maximum number of moves sent in a single request
+        :return: List of moves {"policyid": 10, "option": "after", "target": 2, "result": ...} in the order
+                 they are sent. "result" is None on a dry run
+        """
+        policyids = [int(policyid) for policyid in policyids]
+        current = FortiManagerError.check(
+            self.get_firewall_policies(policy_package_name, fields=["policyid"]))[0].get("data") or []
+        wanted = set(policyids)
+        if len(wanted) != len(policyids):
+            raise ValueError("policyids must not repeat a policy")
+        order = [policy["policyid"] for policy in current if policy["policyid"] in wanted]
+        missing = wanted.difference(order)
+        if missing:
+            raise ValueError(f"policies {sorted(missing)} are not in package {policy_package_name!r}")
+        moves = [{"policyid": policyid, "option": option, "target": target, "result": None}
+                 for policyid, option, target in _minimal_moves(order, policyids)]
+        if moves and not dry_run:
+            batch = self.batch(chunk_size=chunk_size)
+            calls = [batch.move_firewall_policy(policy_package_name, move["policyid"], move["option"],
+                                                move["target"]) for move in moves]
+            batch.execute()
+            for move, call in zip(moves, calls):
+                move["result"] = call.result
+        return moves
+
+    def install_policy_package(self, package_name, scope=None):
         """
         Install the policy package on your Fortigate Firewalls
 
         :param package_name: Enter the package name you wish to install
-        :return: Response of status code with data in JSON Format
+        :param scope: Only install on these devices, as device names or {"name": ..., "vdom": ...}
+                      eg. ["FGT-01", {"name": "FGT-02", "vdom": "root"}]. Default is the package installation targets
+        :return: Response of status code with data in JSON Format. data["task"] holds the install task id
         """
-        session = self.login()
+        data = {
+            "adom": f"{self.adom}",
+            "pkg": f"{package_name}"
+        }
+        if scope:
+            data["scope"] = [device if isinstance(device, dict) else {"name": device, "vdom": "root"}
+                             for device in scope]
         payload = \
             {
                 "method": "exec",
                 "params": [
                     {
-                        "data": {
-                            "adom": f"{self.adom}",
-                            "pkg": f"{package_name}"
-                        },
+                        "data": data,
                         "url": "securityconsole/install/package"
                     }
-                ],
-                "session": self.sessionid
+                ]
             }
-        payload = repr(payload)
-        install_package = session.post(url=self.base_url, data=payload, verify=self.verify)
-        return install_package.json()["result"]
+        return self._post(payload)
 
-    @staticmethod
-    def make_data(_for="policy", **kwargs):
-        object_maps = \
+    # Workspace Methods
+    def _workspace(self, action, package_name=None):
+        url = f"dvmdb/adom/{self.adom}/workspace/{action}"
+        if package_name:
+            url = f"dvmdb/adom/{self.adom}/workspace/{action}/pkg/{package_name}"
+        payload = \
             {
-                "allow_routing": "allow-routing",
-                "associated_interface": "associated-interface",
-                "comment": "comment",
-                "object_name": "name",
-                "subnet": "subnet",
-                "object_type": "type"
+                "method": "exec",
+                "params": [
+                    {
+                        "url": url
+                    }
+                ]
             }
-        policy_maps = \
+        return self._post(payload)
+
+    def lock_adom(self, package_name=None):
+        """
+        Lock the adom in workspace mode, so that the session can change it
+        :param package_name: Only lock this policy package
+        :return: Response of status code with data in JSON Format
+        """
+        return self._workspace("lock", package_name)
+
+    def commit_adom(self, package_name=None):
+        """
+        Save the changes made to the locked adom or policy package
+        :param package_name: Commit this locked policy package
+        :return: Response of status code with data in JSON Format
+        """
+        return self._workspace("commit", package_name)
+
+    def unlock_adom(self, package_name=None):
+        """
+        Release the lock of the adom or policy package. Changes not committed are discarded
+        :param package_name: Unlock this policy package
+        :return: Response of status code with data in JSON Format
+        """
+        return self._workspace("unlock", package_name)
+
+    @contextlib.contextmanager
+    def transaction(self, package_name=None, chunk_size=100):
+        """
+        Make a set of changes in a workspace mode adom with a single lock and commit.
+        The adom (or only the policy package) is locked on entry and the batch is yielded. On exit the batch is
+        executed, then committed and unlocked. When the block raises or an operation fails, the adom is unlocked
+        without commit, which discards the changes.
+
+        >>> with fortimngr.transaction() as batch:
+        ...     batch.add_firewall_address_object(name="Test_Object", subnet=["10.0.0.1", "255.255.255.255"])
+        ...     batch.add_address_group(name="Test_Group", members=["Test_Object"])
+
+        :param package_name: Only lock this policy package
+        :param chunk_size: Maximum number of operations sent in a single request
+        :return: Batch
+        """
+        FortiManagerError.check(self.lock_adom(package_name))
+        committed = False
+        try:
+            batch = self.batch(chunk_size=chunk_size)
+            yield batch
+            for result in batch.execute():
+                FortiManagerError.check(result)
+            FortiManagerError.check(self.commit_adom(package_name))
+            committed = True
+        finally:
+            self.unlock_adom(package_name)
+            if not committed:
+                # The changes are discarded, so reads made or cached during the transaction are stale
+                if self.cache is not None:
+                    self.cache.clear(self.adom)
+                if self.single_flight is not None:
+                    self.single_flight.forget()
+
+    # Task Methods
+    def get_task(self, task_id, lines=False):
+        """
+        Get the progress of a FortiManager task eg. a policy package install
+
+        :param task_id: Enter the task id returned by the call that started the task
+        :param lines: Get the per device lines of the task instead of the task itself
+        :return: Response of status code with data in JSON Format
+        """
+        url = f"task/task/{task_id}"
+        if lines:
+            url = f"task/task/{task_id}/line"
+        payload = \
             {
-                "name": "name",
-                "source_interface": "srcintf",
-                "source_address": "srcaddr",
-                "destination_interface": "dstintf",
-                "destination_address": "dstaddr",
-                "service": "service",
-                "schedule": "schedule",
-                "action": "action",
-                "logtraffic": "logtraffic",
-                "comment": "comments"
+                "method": "get",
+                "params": [
+                    {
+                        "url": url
+                    }
+                ]
             }
+        return self._post(payload)
 
+    @staticmethod
+    def make_data(_for="policy", **kwargs):
         data = {}
         for key, value in kwargs.items():
             if _for == "policy":
-                key = key.replace(key, policy_maps[key])
+                key = key.replace(key, POLICY_MAPS[key])
             elif _for == "object":
-                key = key.replace(key, object_maps[key])
+                key = key.replace(key, OBJECT_MAPS[key])
             data.update({key: value})
         return data
 
@@ -603,3 +1801,2314 @@ class FortiManager:
         comment(str)                    : Comments
         """
         return docs
+
+
+class BatchCall:
+    """
+    Handle for an operation queued in a Batch. "result" holds the same value the
+    FortiManager method would have returned once the batch has been executed.
+    """
+
+    def __init__(self, method, params):
+        self.method = method
+        self.params = params
+        self.result = None
+        self.done = False
+
+
+class Batch:
+    """
+    Collects operations and sends them as multi-param JSON-RPC requests.
+
+    Consecutive operations using the same JSON-RPC method share a request, up to chunk_size
+    operations per request. Operations are sent in the order they were queued.
+
+    >>> with fortimngr.batch(chunk_size=500) as batch:
+    ...     calls = [batch.add_firewall_address_object(name=name, subnet=subnet) for name, subnet in objects]
+    >>> calls[0].result
+    """
+
+    def __init__(self, fortimanager, chunk_size=100):
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be at least 1")
+        self.fortimanager = fortimanager
+        self.chunk_size = chunk_size
+        self.calls = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.execute()
+
+    def __len__(self):
+        return len(self.calls)
+
+    @property
+    def adom(self):
+        return self.fortimanager.adom
+
+    def _post(self, payload):
+        call = BatchCall(payload["method"], payload["params"])
+        self.calls.append(call)
+        return call
+
+    def queue(self, method, url, data=None, **options):
+        """
+        Queue any JSON-RPC operation
+        :param method: JSON-RPC method eg. "add", "update", "delete", "get"
+        :param url: FortiManager url of the table or object
+        :param data: Data of the operation if needed
+        :param options: Any other request options eg. option="before", target="3"
+        :return: BatchCall
+        """
+        params = dict(options, url=url)
+        if data is not None:
+            params["data"] = data
+        return self._post({"method": method, "params": [params]})
+
+    def _requests(self, calls):
+        """
+        Group calls into (method, calls) requests of at most chunk_size operations
+        """
+        method, group, size = None, [], 0
+        for call in calls:
+            if group and (call.method != method or size + len(call.params) > self.chunk_size):
+                yield method, group
+                group, size = [], 0
+            method = call.method
+            group.append(call)
+            size += len(call.params)
+        if group:
+            yield method, group
+
+    def execute(self):
+        """
+        Send all queued operations
+        :return: List of results in the order the operations were queued
+        """
+        calls, self.calls = self.calls, []
+        for method, group in self._requests(calls):
+            params = [param for call in group for param in call.params]
+            result = self.fortimanager._post({"method": method, "params": params})
+            offset = 0
+            for call in group:
+                call.result = result[offset:offset + len(call.params)]
+                call.done = True
+                offset += len(call.params)
+        return [call.result for call in calls]
+
+    make_data = staticmethod(FortiManager.make_data)
+    get_adoms = FortiManager.get_adoms
+    get_devices = FortiManager.get_devices
+    get_policy_packages = FortiManager.get_policy_packages
+    add_policy_package = FortiManager.add_policy_package
+    get_firewall_address_objects = FortiManager.get_firewall_address_objects
+    add_firewall_address_object = FortiManager.add_firewall_address_object
+    update_firewall_address_object = FortiManager.update_firewall_address_object
+    delete_firewall_address_object = FortiManager.delete_firewall_address_object
+    get_address_groups = FortiManager.get_address_groups
+    add_address_group = FortiManager.add_address_group
+    update_address_group = FortiManager.update_address_group
+    delete_address_group = FortiManager.delete_address_group
+    get_firewall_services = FortiManager.get_firewall_services
+    get_service_groups = FortiManager.get_service_groups
+    get_firewall_policies = FortiManager.get_firewall_policies
+    add_firewall_policy = FortiManager.add_firewall_policy
+    update_firewall_policy = FortiManager.update_firewall_policy
+    delete_firewall_policy = FortiManager.delete_firewall_policy
+    move_firewall_policy = FortiManager.move_firewall_policy
+    install_policy_package = FortiManager.install_policy_package
+    _workspace = FortiManager._workspace
+    lock_adom = FortiManager.lock_adom
+    commit_adom = FortiManager.commit_adom
+    unlock_adom = FortiManager.unlock_adom
+    get_task = FortiManager.get_task
+
+
+class AsyncFortiManager:
+    """
+    asyncio version of FortiManager built on aiohttp. Every API method is a coroutine.
+
+    Requests share a pool of at most pool_maxsize connections, and at most max_concurrency
+    requests are in flight at once, so one event loop can drive many calls with asyncio.gather.
+
+    >>> async with AsyncFortiManager(host="", username="", password="") as fortimngr:
+    ...     packages = await fortimngr.get_policy_packages()
+    """
+
+    def __init__(self, host, username="admin", password="admin", adom="root", verify=False, pool_maxsize=100,
+                 max_concurrency=50):
+        if aiohttp is None:
+            raise ImportError("AsyncFortiManager requires aiohttp. Install it with: pip install aiohttp")
+        protocol = "https"
+        self.host = host
+        self.username = username
+        self.password = password
+        self.adom = adom
+        self.sessionid = "null"
+        self.verify = verify
+        self.pool_maxsize = pool_maxsize
+        self.max_concurrency = max_concurrency
+        if not self.verify:
+            protocol = "http"
+        self.base_url = f"{protocol}://{self.host}/jsonrpc"
+        self._session = None
+        self._login_lock = None
+        self._semaphore = None
+
+    async def __aenter__(self):
+        await self.login()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    def _new_session(self):
+        connector = aiohttp.TCPConnector(limit=self.pool_maxsize, ssl=None if self.verify else False)
+        return aiohttp.ClientSession(connector=connector, headers={"Content-Type": "application/json"})
+
+    async def _raw_post(self, body):
+        async with self._semaphore:
+            async with self._session.post(self.base_url, data=body) as response:
+                return json_loads(await response.read())
+
+    async def login(self):
+        """
+        Log in to FortiManager once and keep the session for all calls
+        :return: Session
+        """
+        if self._login_lock is None:
+            self._login_lock = asyncio.Lock()
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        async with self._login_lock:
+            if self._session is None:
+                self._session = self._new_session()
+            if self.sessionid == "null":
+                payload = \
+                    {
+                        "method": "exec",
+                        "params":
+                            [
+                                {
+                                    "data": {
+                                        "passwd": self.password,
+                                        "user": self.username
+                                    },
+                                    "url": "sys/login/user"
+                                }
+                            ],
+                        "session": self.sessionid
+                    }
+                login = await self._raw_post(json_dumps(payload))
+                self.sessionid = login['session']
+            return self._session
+
+    async def logout(self):
+        """
+        Logout from FortiManager
+        :return: Response of status code with data in JSON Format
+        """
+        payload = \
+            {
+                "method": "exec",
+                "params":
+                    [
+                        {
+                            "url": "sys/logout"
+                        }
+                    ],
+                "session": self.sessionid
+            }
+        logout = await self._raw_post(json_dumps(payload))
+        self.sessionid = "null"
+        return logout["result"]
+
+    async def close(self):
+        """
+        Logout if a session is open and release the pooled connections
+        """
+        if self._session is None:
+            return
+        if self.sessionid != "null":
+            await self.logout()
+        await self._session.close()
+        self._session = None
+
+    async def _relogin(self, stale_sessionid):
+        async with self._login_lock:
+            if self.sessionid == stale_sessionid:
+                self.sessionid = "null"
+        return await self.login()
+
+    async def _post(self, payload):
+        """
+        Send a JSON-RPC payload, logging in again and resending once if the session has expired
+        :param payload: JSON-RPC request with "method" and "params"
+        :return: Response of status code with data in JSON Format
+        """
+        template = _request_template(payload)
+        await self.login()
+        sessionid = self.sessionid
+        result = (await self._raw_post(_request_body(template, sessionid)))["result"]
+        if FortiManager._session_expired(result):
+            await self._relogin(sessionid)
+            result = (await self._raw_post(_request_body(template, self.sessionid)))["result"]
+        return result
+
+    make_data = staticmethod(FortiManager.make_data)
+    show_params_for_object_update = staticmethod(FortiManager.show_params_for_object_update)
+    show_params_for_policy_update = staticmethod(FortiManager.show_params_for_policy_update)
+    get_adoms = FortiManager.get_adoms
+    get_devices = FortiManager.get_devices
+    get_policy_packages = FortiManager.get_policy_packages
+    add_policy_package = FortiManager.add_policy_package
+    get_firewall_address_objects = FortiManager.get_firewall_address_objects
+    add_firewall_address_object = FortiManager.add_firewall_address_object
+    update_firewall_address_object = FortiManager.update_firewall_address_object
+    delete_firewall_address_object = FortiManager.delete_firewall_address_object
+    get_address_groups = FortiManager.get_address_groups
+    add_address_group = FortiManager.add_address_group
+    update_address_group = FortiManager.update_address_group
+    delete_address_group = FortiManager.delete_address_group
+    get_firewall_services = FortiManager.get_firewall_services
+    get_service_groups = FortiManager.get_service_groups
+    get_firewall_policies = FortiManager.get_firewall_policies
+    add_firewall_policy = FortiManager.add_firewall_policy
+    update_firewall_policy = FortiManager.update_firewall_policy
+    delete_firewall_policy = FortiManager.delete_firewall_policy
+    move_firewall_policy = FortiManager.move_firewall_policy
+    install_policy_package = FortiManager.install_policy_package
+    _workspace = FortiManager._workspace
+    lock_adom = FortiManager.lock_adom
+    commit_adom = FortiManager.commit_adom
+    unlock_adom = FortiManager.unlock_adom
+    get_task = FortiManager.get_task
+
+
+class InstallEvent:
+    """
+    Progress of one install task, sent to the on_event callback of InstallManager.install()
+    """
+
+    def __init__(self, package, task_id, percent, state, message=None):
+        self.package = package
+        self.task_id = task_id
+        self.percent = percent
+        self.state = state
+        self.message = message
+
+    def __repr__(self):
+        return f"InstallEvent(package={self.package!r}, task_id={self.task_id!r}, percent={self.percent!r}, " \
+               f"state={self.state!r})"
+
+
+class InstallResult:
+    """
+    Outcome of installing one policy package. "devices" holds the per device lines of the task.
+    """
+
+    def __init__(self, package, scope=None):
+        self.package = package
+        self.scope = scope
+        self.task_id = None
+        self.percent = 0
+        self.state = None
+        self.devices = []
+        self.error = None
+
+    @property
+    def ok(self):
+        return self.error is None and self.state in InstallManager.SUCCESS_STATES and \
+            all(device.get("state") in InstallManager.SUCCESS_STATES for device in self.devices)
+
+    def __repr__(self):
+        return f"InstallResult(package={self.package!r}, task_id={self.task_id!r}, state={self.state!r}, " \
+               f"error={self.error!r})"
+
+
+class InstallManager:
+    """
+    Install many policy packages at once and wait for all of them.
+
+    Installs are started in parallel, then every running task is polled with a single batched request per round.
+    The polling interval starts at poll_interval, grows by the backoff factor up to max_poll_interval while no
+    task makes progress, and drops back as soon as one does.
+
+    >>> results = InstallManager(fortimngr).install([("default", ["FGT-01", "FGT-02"]), "Branch"],
+    ...                                              on_event=print)
+    """
+
+    # FortiManager reports task states either by name or by number
+    SUCCESS_STATES = ("done", 4)
+    FINAL_STATES = ("done", "error", "cancelled", "aborted", "warning", 3, 4, 5, 7, 8)
+
+    def __init__(self, fortimanager, max_workers=10, poll_interval=1.0, max_poll_interval=15.0, backoff=1.5,
+                 timeout=3600):
+        self.fortimanager = fortimanager
+        self.max_workers = max_workers
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.backoff = backoff
+        self.timeout = timeout
+
+    def install(self, jobs, on_event=None):
+        """
+        Install the policy packages and wait until every install has finished
+        :param jobs: Package names, or (package name, scope) tuples to install on some devices only
+        :param on_event: Called with an InstallEvent each time a task makes progress
+        :return: List of InstallResult in the order of jobs
+        """
+        results = [InstallResult(*job) if isinstance(job, (tuple, list)) else InstallResult(job) for job in jobs]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            list(executor.map(self._start, results))
+        self._wait([result for result in results if result.error is None], on_event)
+        return results
+
+    def _start(self, result):
+        try:
+            response = FortiManagerError.check(
+                self.fortimanager.install_policy_package(result.package, scope=result.scope))
+            result.task_id = response[0]["data"]["task"]
+        except Exception as error:
+            result.error = error
+
+    def _wait(self, active, on_event):
+        interval = self.poll_interval
+        deadline = time.monotonic() + self.timeout
+        while active:
+            if time.monotonic() > deadline:
+                for result in active:
+                    result.error = TimeoutError(f"install task {result.task_id} did not finish in {self.timeout}s")
+                return
+            time.sleep(interval)
+            batch = self.fortimanager.batch()
+            calls = [batch.get_task(result.task_id) for result in active]
+            batch.execute()
+            progressed = False
+            for result, call in zip(list(active), calls):
+                status = call.result[0].get("status", {})
+                if status.get("code", 0) != 0:
+                    active.remove(result)
+                    result.error = FortiManagerError(status.get("code"), status.get("message"),
+                                                     call.result[0].get("url"))
+                    continue
+                task = call.result[0].get("data") or {}
+                percent, state = task.get("percent", result.percent), task.get("state", result.state)
+                if (percent, state) == (result.percent, result.state):
+                    continue
+                progressed = True
+                result.percent, result.state = percent, state
+                if state in self.FINAL_STATES:
+                    active.remove(result)
+                    result.devices = self.fortimanager.get_task(result.task_id, lines=True)[0].get("data") or []
+                if on_event is not None:
+                    on_event(InstallEvent(result.package, result.task_id, percent, state, task.get("title")))
+            interval = self.poll_interval if progressed else min(interval * self.backoff, self.max_poll_interval)
+
+
+def _minimal_moves(current, target):
+    """
+    Compute the fewest "move" operations that turn the order current into the order target.
+    The items forming the longest increasing subsequence of current positions stay in place, every other
+    item is moved right after its predecessor in target (or before the first staying item).
+
+    :param current: Items in their current order. Items missing from target are ignored
+    :param target: The same items in the wanted order
+    :return: List of (item, option, anchor) with option "before" or "after"
+    """
+    position = {item: index for index, item in enumerate(current)}
+    sequence = [position[item] for item in target]
+    # Patience sorting: tails[k] is the index in sequence of the smallest tail of an increasing run of length k + 1
+    tails, previous = [], [-1] * len(sequence)
+    for index, value in enumerate(sequence):
+        low, high = 0, len(tails)
+        while low < high:
+            middle = (low + high) // 2
+            if sequence[tails[middle]] < value:
+                low = middle + 1
+            else:
+                high = middle
+        previous[index] = tails[low - 1] if low else -1
+        if low == len(tails):
+            tails.append(index)
+        else:
+            tails[low] = index
+    staying = set()
+    index = tails[-1] if tails else -1
+    while index != -1:
+        staying.add(index)
+        index = previous[index]
+    moves = []
+    for index, item in enumerate(target):
+        if index in staying:
+            continue
+        if index:
+            moves.append((item, "after", target[index - 1]))
+        else:
+            moves.append((item, "before", target[min(staying)]))
+    return moves
+
+
+class SyncChange:
+    """
+    One operation of a SyncPlan. "key" is the object name, or the policy name/policyid.
+    """
+
+    def __init__(self, table, action, key, data=None, option=None, target=None):
+        self.table = table
+        self.action = action
+        self.key = key
+        self.data = data
+        self.option = option
+        self.target = target
+        self.result = None
+
+    @property
+    def failed(self):
+        return self.result is not None and any(entry.get("status", {}).get("code", 0) != 0 for entry in self.result)
+
+    def __repr__(self):
+        if self.action == "move":
+            return f"SyncChange({self.table} move {self.key!r} {self.option} {self.target!r})"
+        return f"SyncChange({self.table} {self.action} {self.key!r})"
+
+
+class SyncPlan:
+    """
+    Changes needed to reach the desired state, in the order they are applied
+    """
+
+    def __init__(self, changes):
+        self.changes = changes
+
+    def __len__(self):
+        return len(self.changes)
+
+    def __iter__(self):
+        return iter(self.changes)
+
+    def summary(self):
+        """
+        :return: Dictionary of change counts eg. {"address add": 3, "policy move": 1}
+        """
+        counts = {}
+        for change in self.changes:
+            name = f"{change.table} {change.action}"
+            counts[name] = counts.get(name, 0) + 1
+        return counts
+
+    @property
+    def errors(self):
+        return [change for change in self.changes if change.failed]
+
+
+class SyncEngine:
+    """
+    Bring address objects, address groups and the policies of one package to a desired state.
+
+    The desired state is a dictionary with any of the keys "addresses", "groups" and "policies", each one a list
+    of entries using FortiManager attribute names. Only the tables present in it are managed. Objects and groups
+    are matched by name, policies by policyid when given and by name otherwise. The order of "policies" is the
+    wanted policy order. With prune=True, the entries of a managed table missing from the desired state are
+    deleted, except the predefined objects of ReferenceGraph.KEEP.
+
+    The current state is read with one request. Entries are compared through a hash of the attributes given in the
+    desired state, so unchanged entries cost nothing, and changes are sent in dependency order with batched
+    requests: objects, groups and policies are added or updated first, then policies are moved, then policies,
+    groups and objects are deleted.
+
+    >>> engine = SyncEngine(fortimngr, policy_package_name="default")
+    >>> plan = engine.sync(desired, dry_run=True)
+    >>> plan.summary()
+    """
+
+    # Attributes compared regardless of the order of their values
+    UNORDERED_FIELDS = ("member", "srcaddr", "dstaddr", "srcintf", "dstintf", "service", "groups", "users")
+
+    def __init__(self, fortimanager, policy_package_name="default", chunk_size=100, prune=False):
+        self.fortimanager = fortimanager
+        self.policy_package_name = policy_package_name
+        self.chunk_size = chunk_size
+        self.prune = prune
+
+    def _url(self, table, key=None):
+        adom = self.fortimanager.adom
+        url = {
+            "address": f"pm/config/adom/{adom}/obj/firewall/address",
+            "group": f"pm/config/adom/{adom}/obj/firewall/addrgrp",
+            "policy": f"pm/config/adom/{adom}/pkg/{self.policy_package_name}/firewall/policy",
+        }[table]
+        return url if key is None else f"{url}/{key}"
+
+    @classmethod
+    def _normalize(cls, field, value):
+        if isinstance(value, (list, tuple)):
+            values = [cls._normalize(None, item) for item in value]
+            if len(values) == 1:
+                return values[0]
+            return sorted(values, key=json_dumps) if field in cls.UNORDERED_FIELDS else values
+        return value
+
+    @classmethod
+    def fingerprint(cls, entry, fields):
+        """
+        Hash of the given attributes of an entry, used to spot changed entries
+        """
+        projection = {field: cls._normalize(field, entry.get(field)) for field in sorted(fields)}
+        return hashlib.sha1(json_dumps(projection)).hexdigest()
+
+    @staticmethod
+    def _policy_key(entry):
+        return entry["policyid"] if entry.get("policyid") is not None else entry.get("name")
+
+    def fetch(self, desired):
+        """
+        Read the current entries of the managed tables with a single request
+        :return: Dictionary of table name to list of entries
+        """
+        fields = {
+            "addresses": {"name"},
+            "groups": {"name", "member"},
+            "policies": {"name", "policyid"},
+        }
+        batch = self.fortimanager.batch(chunk_size=self.chunk_size)
+        calls = {}
+        for table, url in (("addresses", "address"), ("groups", "group"), ("policies", "policy")):
+            if table in desired:
+                wanted = fields[table].union(*(entry.keys() for entry in desired[table]))
+                calls[table] = batch.queue("get", self._url(url), fields=sorted(wanted))
+        batch.execute()
+        return {table: FortiManagerError.check(call.result)[0].get("data") or [] for table, call in calls.items()}
+
+    def _diff(self, desired, current, key):
+        """
+        Match desired entries with current ones. Policies are matched by policyid when the desired entry has one,
+        by name otherwise.
+        :return: (list of the matching current entry or None for each desired entry,
+                  list of (current entry, changed attributes), list of unmatched current entries)
+        """
+        by_key = {}
+        for entry in current:
+            by_key.setdefault(entry.get("name"), entry)
+            if key == "policyid":
+                by_key[entry.get("policyid")] = entry
+        matches, updates, matched = [], [], set()
+        for entry in desired:
+            existing = by_key.get(entry[key] if entry.get(key) is not None else entry.get("name"))
+            if existing is not None and id(existing) in matched:
+                raise ValueError(f"desired state lists {entry.get(key) or entry.get('name')!r} twice")
+            matches.append(existing)
+            if existing is None:
+                continue
+            matched.add(id(existing))
+            if self.fingerprint(entry, entry.keys()) != self.fingerprint(existing, entry.keys()):
+                changed = {field: value for field, value in entry.items()
+                           if self._normalize(field, value) != self._normalize(field, existing.get(field))}
+                updates.append((existing, changed))
+        unmatched = [entry for entry in current if id(entry) not in matched] if self.prune else []
+        return matches, updates, unmatched
+
+    @staticmethod
+    def _group_order(groups):
+        """
+        Order groups so that a group comes after the groups it contains
+        """
+        by_name = {group["name"]: group for group in groups}
+        ordered, state = [], {}
+
+        def visit(name):
+            if state.get(name) == "done":
+                return
+            if state.get(name) == "visiting":
+                raise ValueError(f"address group {name!r} contains itself")
+            state[name] = "visiting"
+            members = by_name[name].get("member") or []
+            for member in [members] if isinstance(members, str) else members:
+                if member in by_name:
+                    visit(member)
+            state[name] = "done"
+            ordered.append(by_name[name])
+
+        for group_name in by_name:
+            visit(group_name)
+        return ordered
+
+    def plan(self, desired, current=None):
+        """
+        Compute the changes needed to reach the desired state
+        :param desired: Desired state, see the class documentation
+        :param current: Current state as returned by fetch(). Fetched when not given
+        :return: SyncPlan
+        """
+        if current is None:
+            current = self.fetch(desired)
+        changes, deletes = [], []
+        if "addresses" in desired:
+            matches, updates, removed = self._diff(desired["addresses"], current["addresses"], "name")
+            changes += [SyncChange("address", "add", entry["name"], data=entry)
+                        for entry, existing in zip(desired["addresses"], matches) if existing is None]
+            changes += [SyncChange("address", "update", existing["name"], data=data) for existing, data in updates]
+            deletes.append([SyncChange("address", "delete", entry["name"]) for entry in removed
+                            if entry["name"] not in ReferenceGraph.KEEP])
+        if "groups" in desired:
+            matches, updates, removed = self._diff(desired["groups"], current["groups"], "name")
+            adds = [entry for entry, existing in zip(desired["groups"], matches) if existing is None]
+            changes += [SyncChange("group", "add", entry["name"], data=entry) for entry in self._group_order(adds)]
+            changes += [SyncChange("group", "update", existing["name"], data=data) for existing, data in updates]
+            removed = [entry for entry in removed if entry["name"] not in ReferenceGraph.KEEP]
+            deletes.append([SyncChange("group", "delete", entry["name"])
+                            for entry in reversed(self._group_order(removed))])
+        if "policies" in desired:
+            matches, updates, removed = self._diff(desired["policies"], current["policies"], "policyid")
+            # Existing policies are referred to by policyid, new ones by name until FortiManager assigns their id
+            target = [existing["policyid"] if existing is not None else entry["name"]
+                      for entry, existing in zip(desired["policies"], matches)]
+            changes += [SyncChange("policy", "add", entry["name"], data=entry)
+                        for entry, existing in zip(desired["policies"], matches) if existing is None]
+            changes += [SyncChange("policy", "update", existing["policyid"], data=data)
+                        for existing, data in updates]
+            matched = {id(existing) for existing in matches}
+            order = [entry["policyid"] for entry in current["policies"] if id(entry) in matched]
+            order += [entry["name"] for entry, existing in zip(desired["policies"], matches) if existing is None]
+            changes += [SyncChange("policy", "move", key, option=option, target=anchor)
+                        for key, option, anchor in _minimal_moves(order, target)]
+            deletes.append([SyncChange("policy", "delete", entry["policyid"]) for entry in removed])
+        for group in reversed(deletes):
+            changes += group
+        return SyncPlan(changes)
+
+    def apply(self, plan):
+        """
+        Send the changes of a plan. Additions and updates go first so that the policyids FortiManager assigns to
+        new policies are known to the moves.
+        :param plan: SyncPlan from plan()
+        :return: The plan, with the result of each change set
+        """
+        added = {change.key for change in plan if change.table == "policy" and change.action == "add"}
+        policyids = {}
+
+        def resolve(key):
+            # New policies are known by name until FortiManager assigns their policyid
+            return policyids.get(key) if key in added else key
+
+        def send(changes):
+            batch = self.fortimanager.batch(chunk_size=self.chunk_size)
+            calls = []
+            for change in changes:
+                if change.action == "move" and (resolve(change.key) is None or resolve(change.target) is None):
+                    # Moving by name would address a policy that does not exist, fail the move instead
+                    unresolved = change.key if resolve(change.key) is None else change.target
+                    calls.append(None)
+                    change.result = [{"status": {"code": -3, "message": f"policy {unresolved!r} was not created"}}]
+                elif change.action == "add":
+                    calls.append(batch.queue("add", self._url(change.table), data=change.data))
+                elif change.action == "update":
+                    calls.append(batch.queue("update", self._url(change.table, change.key), data=change.data))
+                elif change.action == "move":
+                    calls.append(batch.queue("move", self._url("policy", resolve(change.key)), option=change.option,
+                                             target=str(resolve(change.target))))
+                else:
+                    calls.append(batch.queue("delete", self._url(change.table, change.key)))
+            batch.execute()
+            for change, call in zip(changes, calls):
+                if call is not None:
+                    change.result = call.result
+
+        first = [change for change in plan if change.action in ("add", "update")]
+        send(first)
+        for change in first:
+            if change.table == "policy" and change.action == "add" and not change.failed:
+                policyids[change.key] = (change.result[0].get("data") or {}).get("policyid")
+        send([change for change in plan if change.action in ("move", "delete")])
+        return plan
+
+    def sync(self, desired, dry_run=False):
+        """
+        Fetch the current state, plan the changes and apply them
+        :param desired: Desired state, see the class documentation
+        :param dry_run: Only compute the plan, do not change anything
+        :return: SyncPlan
+        """
+        current = self.fetch(desired)
+        plan = self.plan(desired, current)
+        if not dry_run and plan:
+            self.apply(plan)
+        return plan
+
+
+class AddressIndex:
+    """
+    Radix trie over the networks of address objects, answering lookups in O(prefix length).
+
+    ipmask objects are indexed by their subnet, iprange objects by the smallest set of networks covering the range.
+    Other object types (fqdn, geography...) are ignored.
+
+    >>> index = AddressIndex.from_fortimanager(fortimngr)
+    >>> index.longest_prefix("10.20.30.40")
+    >>> index.containing("10.20.30.0/24")
+    >>> index.duplicates("10.20.30.0/24")
+    >>> index.attach(fortimngr)   # follow the writes made through fortimngr
+    """
+
+    # Attributes the networks of an object depend on
+    FIELDS = ("type", "subnet", "start-ip", "end-ip")
+
+    def __init__(self, addresses=(), adom=None):
+        self.adom = adom
+        # Node: [child for bit 0, child for bit 1, set of object names ending here]
+        self._roots = {4: [None, None, set()], 6: [None, None, set()]}
+        self._networks = {}
+        # Last known ip attributes of every object, to apply partial updates
+        self._attributes = {}
+        for address in addresses:
+            self.add(address)
+
+    def __len__(self):
+        return len(self._networks)
+
+    def __contains__(self, name):
+        return name in self._networks
+
+    @classmethod
+    def from_fortimanager(cls, fortimanager, page_size=5000):
+        """
+        Build the index from the address objects of the adom of fortimanager
+        """
+        fields = ["name"] + list(cls.FIELDS)
+        return cls(fortimanager.iter_firewall_address_objects(page_size=page_size, fields=fields),
+                   adom=fortimanager.adom)
+
+    @staticmethod
+    def networks(address):
+        """
+        Networks covered by an address object
+        :param address: Address object as returned by FortiManager
+        :return: List of ipaddress networks, empty for types that are not ip based
+        """
+        object_type = address.get("type", 0)
+        try:
+            if object_type in (1, "iprange"):
+                start = ipaddress.ip_address(address["start-ip"])
+                end = ipaddress.ip_address(address["end-ip"])
+                return list(ipaddress.summarize_address_range(start, end))
+            if object_type in (0, "ipmask") and address.get("subnet"):
+                subnet = address["subnet"]
+                if isinstance(subnet, (list, tuple)):
+                    subnet = "/".join(subnet)
+                return [ipaddress.ip_network(subnet.replace(" ", "/"), strict=False)]
+        except (KeyError, TypeError, ValueError):
+            pass
+        return []
+
+    @staticmethod
+    def _bits(network):
+        value = int(network.network_address)
+        width = network.max_prefixlen
+        return ((value >> (width - 1 - depth)) & 1 for depth in range(network.prefixlen))
+
+    def _path(self, network):
+        """
+        Yield the nodes from the root down to the node of network, as far as they exist
+        """
+        node = self._roots[network.version]
+        yield node
+        for bit in self._bits(network):
+            node = node[bit]
+            if node is None:
+                return
+            yield node
+
+    def add(self, address):
+        """
+        Index an address object, replacing the object of the same name
+        """
+        name = address["name"]
+        self.remove(name)
+        self._attributes[name] = {field: address[field] for field in self.FIELDS if field in address}
+        networks = self.networks(address)
+        if not networks:
+            return
+        for network in networks:
+            node = self._roots[network.version]
+            for bit in self._bits(network):
+                if node[bit] is None:
+                    node[bit] = [None, None, set()]
+                node = node[bit]
+            node[2].add(name)
+        self._networks[name] = networks
+
+    def remove(self, name):
+        """
+        Drop an address object from the index
+        """
+        self._attributes.pop(name, None)
+        for network in self._networks.pop(name, []):
+            node = None
+            for node in self._path(network):
+                pass
+            if node is not None:
+                node[2].discard(name)
+
+    def rename(self, name, new_name):
+        if name in self._attributes:
+            self._attributes[new_name] = self._attributes.pop(name)
+        networks = self._networks.pop(name, None)
+        if networks is None:
+            return
+        for network in networks:
+            for node in self._path(network):
+                pass
+            node[2].discard(name)
+            node[2].add(new_name)
+        self._networks[new_name] = networks
+
+    @staticmethod
+    def _network(value):
+        return value if isinstance(value, (ipaddress.IPv4Network, ipaddress.IPv6Network)) else \
+            ipaddress.ip_network(value, strict=False)
+
+    def containing(self, value):
+        """
+        Objects whose network contains an ip address or a network
+        :param value: eg. "10.20.30.40" or "10.20.30.0/24"
+        :return: Set of object names
+        """
+        names = set()
+        for node in self._path(self._network(value)):
+            names.update(node[2])
+        return names
+
+    def longest_prefix(self, value):
+        """
+        Most specific objects containing an ip address or a network
+        :return: Set of object names, empty when no object contains it
+        """
+        names = set()
+        for node in self._path(self._network(value)):
+            if node[2]:
+                names = node[2]
+        return set(names)
+
+    def duplicates(self, value):
+        """
+        Objects whose network is exactly the given network
+        :return: Set of object names
+        """
+        network = self._network(value)
+        depth, node = -1, None
+        for depth, node in enumerate(self._path(network)):
+            pass
+        return set(node[2]) if depth == network.prefixlen else set()
+
+    def within(self, value):
+        """
+        Objects whose network lies inside the given network
+        :return: Set of object names
+        """
+        network = self._network(value)
+        depth, node = -1, None
+        for depth, node in enumerate(self._path(network)):
+            pass
+        if depth != network.prefixlen:
+            return set()
+        names, stack = set(), [node]
+        while stack:
+            node = stack.pop()
+            names.update(node[2])
+            stack.extend(child for child in node[:2] if child is not None)
+        return names
+
+    def duplicate_groups(self):
+        """
+        Every network defined by more than one object
+        :return: Dictionary of network to set of object names
+        """
+        groups = {}
+        for name, networks in self._networks.items():
+            for network in networks:
+                groups.setdefault(network, set()).add(name)
+        return {network: names for network, names in groups.items() if len(names) > 1}
+
+    def attach(self, fortimanager):
+        """
+        Keep the index up to date with the address objects added, updated and deleted through fortimanager
+        """
+        if self.adom is None:
+            self.adom = fortimanager.adom
+        fortimanager.add_hook(self)
+        return self
+
+    def __call__(self, event):
+        if event.method == "get" or event.result is None:
+            return
+        pattern = re.compile(rf"^/?pm/config/adom/{re.escape(str(self.adom))}/obj/firewall/address(?:/([^/]+))?/?$")
+        for params, entry in zip(event.params, event.result):
+            match = pattern.match(params.get("url", ""))
+            if match is None or entry.get("status", {}).get("code", 0) != 0:
+                continue
+            name, data = match.group(1), params.get("data")
+            if event.method == "delete" and name:
+                self.remove(name)
+            elif event.method in ("add", "set") and not name:
+                for address in data if isinstance(data, list) else [data]:
+                    self.add(address)
+            elif event.method in ("update", "set") and name and isinstance(data, dict):
+                if data.get("name", name) != name:
+                    self.rename(name, data["name"])
+                    name = data["name"]
+                if set(self.FIELDS).intersection(data):
+                    # An update may carry only some attributes, eg. the end-ip of a range
+                    merged = dict(self._attributes.get(name, {}))
+                    merged.update((field, data[field]) for field in self.FIELDS if field in data)
+                    self.add(dict(merged, name=name))
+
+
+class PolicyIndex:
+    """
+    Compiled first-match index over the policies of a package, to test flows and find shadowed rules offline.
+
+    Address groups are resolved to the IPv4 ranges of their members and service groups to protocol and
+    destination port ranges. Each dimension (source, destination, service, interfaces) is cut into elementary
+    segments, every segment holding a bitmask of the rules that contain it, so matching a flow is three bisects
+    and an AND of bitmasks, whatever the number of rules.
+
+    Disabled rules and schedules are ignored. Rules using objects that cannot be resolved to ranges (fqdn,
+    geography, source ports, missing objects...) are kept for matching with what could be resolved, but are
+    listed in unresolved and never reported as shadowed.
+
+    >>> index = PolicyIndex.from_fortimanager(fortimngr, policy_package_name="default")
+    >>> index.match("10.0.0.5", "8.8.8.8", "udp", 53, srcintf="port1", dstintf="port2")
+    >>> index.match_many(flows)
+    >>> index.shadowed()
+    """
+
+    PROTOCOLS = {"icmp": 1, "tcp": 6, "udp": 17, "sctp": 132}
+    ANY = ("all", "any", "ALL")
+    _IPV4_MAX = 2 ** 32 - 1
+    _SERVICE_MAX = 256 * 65536 - 1
+
+    def __init__(self, policies, addresses=(), address_groups=(), services=(), service_groups=()):
+        self._address_entries = {entry["name"]: entry for entry in addresses}
+        self._address_groups = {entry["name"]: entry.get("member") or [] for entry in address_groups}
+        self._service_entries = {entry["name"]: entry for entry in services}
+        self._service_groups = {entry["name"]: entry.get("member") or [] for entry in service_groups}
+        self._resolved = {}
+        self.rules = []
+        self.unresolved = {}
+        for policy in policies:
+            if policy.get("status", 1) in (0, "disable"):
+                continue
+            self._compile(policy)
+        self._build()
+
+    @classmethod
+    def from_fortimanager(cls, fortimanager, policy_package_name="default", chunk_size=100):
+        """
+        Build the index from the policies of a package and the objects of the adom, read with a single request
+        """
+        adom = fortimanager.adom
+        tables = {
+            "policies": f"pm/config/adom/{adom}/pkg/{policy_package_name}/firewall/policy",
+            "addresses": f"pm/config/adom/{adom}/obj/firewall/address",
+            "address_groups": f"pm/config/adom/{adom}/obj/firewall/addrgrp",
+            "services": f"pm/config/adom/{adom}/obj/firewall/service/custom",
+            "service_groups": f"pm/config/adom/{adom}/obj/firewall/service/group",
+        }
+        batch = fortimanager.batch(chunk_size=chunk_size)
+        calls = {table: batch.queue("get", url) for table, url in tables.items()}
+        batch.execute()
+        return cls(**{table: FortiManagerError.check(call.result)[0].get("data") or []
+                      for table, call in calls.items()})
+
+    # Object resolution
+    @staticmethod
+    def _merge(ranges):
+        merged = []
+        for low, high in sorted(ranges):
+            if merged and low <= merged[-1][1] + 1:
+                merged[-1][1] = max(merged[-1][1], high)
+            else:
+                merged.append([low, high])
+        return tuple((low, high) for low, high in merged)
+
+    @staticmethod
+    def _complement(ranges, maximum):
+        result, start = [], 0
+        for low, high in ranges:
+            if low > start:
+                result.append((start, low - 1))
+            start = high + 1
+        if start <= maximum:
+            result.append((start, maximum))
+        return tuple(result)
+
+    def _address(self, name, seen=()):
+        """
+        :return: (merged IPv4 ranges, True when the object was fully resolved)
+        """
+        if name in self.ANY and name not in self._address_entries and name not in self._address_groups:
+            return ((0, self._IPV4_MAX),), True
+        if name in self._address_groups:
+            if name in seen:
+                return (), False
+            ranges, exact = [], True
+            for member in self._address_groups[name]:
+                member_ranges, member_exact = self._address(member, seen + (name,))
+                ranges.extend(member_ranges)
+                exact = exact and member_exact
+            return self._merge(ranges), exact
+        entry = self._address_entries.get(name)
+        if entry is None:
+            return (), False
+        networks = [network for network in AddressIndex.networks(entry) if network.version == 4]
+        ranges = [(int(network.network_address), int(network.broadcast_address)) for network in networks]
+        return self._merge(ranges), bool(ranges)
+
+    @staticmethod
+    def _ports(value):
+        low, _, high = str(value).partition("-")
+        return int(low), int(high or low)
+
+    def _service(self, name, seen=()):
+        """
+        :return: (merged ranges of protocol * 65536 + destination port, True when the service was fully resolved)
+        """
+        if name in self._service_groups:
+            if name in seen:
+                return (), False
+            ranges, exact = [], True
+            for member in self._service_groups[name]:
+                member_ranges, member_exact = self._service(member, seen + (name,))
+                ranges.extend(member_ranges)
+                exact = exact and member_exact
+            return self._merge(ranges), exact
+        entry = self._service_entries.get(name)
+        if entry is None:
+            if name in self.ANY:
+                return ((0, self._SERVICE_MAX),), True
+            return (), False
+        protocol = str(entry.get("protocol", "TCP/UDP/SCTP")).upper()
+        if protocol in ("IP", "0"):
+            number = int(entry.get("protocol-number") or 0)
+            if number == 0:
+                return ((0, self._SERVICE_MAX),), True
+            return ((number << 16, (number << 16) + 65535),), True
+        if protocol in ("ICMP", "1"):
+            return ((1 << 16, (1 << 16) + 65535),), True
+        if protocol not in ("TCP/UDP/SCTP", "5", "TCP/UDP/UDP-LITE/SCTP"):
+            return (), False
+        ranges, exact = [], True
+        for field, number in (("tcp-portrange", 6), ("udp-portrange", 17), ("sctp-portrange", 132)):
+            values = entry.get(field) or []
+            for value in values.split() if isinstance(values, str) else values:
+                destination, _, source = str(value).partition(":")
+                try:
+                    low, high = self._ports(destination)
+                except ValueError:
+                    exact = False
+                    continue
+                if source and self._ports(source) != (0, 65535):
+                    exact = False
+                ranges.append(((number << 16) + low, (number << 16) + high))
+        return self._merge(ranges), exact and bool(ranges)
+
+    def _resolve(self, kind, names, negate):
+        key = (kind, tuple(sorted(names)), negate)
+        if key not in self._resolved:
+            resolve, maximum = (self._address, self._IPV4_MAX) if kind != "service" else \
+                (self._service, self._SERVICE_MAX)
+            ranges, missing = [], []
+            for name in names:
+                name_ranges, name_exact = resolve(name)
+                ranges.extend(name_ranges)
+                if not name_exact:
+                    missing.append(name)
+            ranges = self._merge(ranges)
+            if negate:
+                ranges = self._complement(ranges, maximum)
+            self._resolved[key] = (ranges, missing)
+        return self._resolved[key]
+
+    @staticmethod
+    def _names(value):
+        if value is None:
+            return []
+        return [value] if isinstance(value, str) else list(value)
+
+    def _compile(self, policy):
+        rule = {"policyid": policy.get("policyid"), "name": policy.get("name"),
+                "action": {0: "deny", 1: "accept", 2: "ipsec"}.get(policy.get("action"), policy.get("action"))}
+        missing = []
+        for kind, field in (("address", "srcaddr"), ("address", "dstaddr"), ("service", "service")):
+            negate = policy.get(f"{field}-negate") in (1, "enable")
+            rule[field], field_missing = self._resolve(kind, self._names(policy.get(field)), negate)
+            missing.extend(field_missing)
+        for field in ("srcintf", "dstintf"):
+            names = self._names(policy.get(field))
+            rule[field] = None if not names or "any" in names else frozenset(names)
+        if missing:
+            self.unresolved[rule["policyid"]] = sorted(set(missing))
+        self.rules.append(rule)
+
+    # Compilation
+    def _build(self):
+        self._segments = {}
+        for field in ("srcaddr", "dstaddr", "service"):
+            bounds = sorted({low for rule in self.rules for low, _ in rule[field]} |
+                            {high + 1 for rule in self.rules for _, high in rule[field]} | {0})
+            # Ranges of a rule are disjoint, so toggling its bit where they start and end gives its segments
+            toggles = [0] * (len(bounds) + 1)
+            for position, rule in enumerate(self.rules):
+                bit = 1 << position
+                for low, high in rule[field]:
+                    toggles[bisect.bisect_left(bounds, low)] ^= bit
+                    toggles[bisect.bisect_left(bounds, high + 1)] ^= bit
+            masks, mask = [], 0
+            for toggle in toggles[:len(bounds)]:
+                mask ^= toggle
+                masks.append(mask)
+            self._segments[field] = (bounds, masks)
+        self._interfaces = {}
+        for field in ("srcintf", "dstintf"):
+            wildcard, names = 0, {}
+            for position, rule in enumerate(self.rules):
+                if rule[field] is None:
+                    wildcard |= 1 << position
+                else:
+                    for name in rule[field]:
+                        names[name] = names.get(name, 0) | 1 << position
+            self._interfaces[field] = (wildcard, {name: mask | wildcard for name, mask in names.items()})
+        self._all = (1 << len(self.rules)) - 1
+
+    def _segment(self, field, value):
+        bounds, _ = self._segments[field]
+        return bisect.bisect_right(bounds, value) - 1
+
+    def _interface_mask(self, field, name):
+        if name is None:
+            return self._all
+        wildcard, names = self._interfaces[field]
+        return names.get(name, wildcard)
+
+    @staticmethod
+    def _ip(value):
+        return value if isinstance(value, int) else int.from_bytes(socket.inet_aton(value), "big")
+
+    def _service_key(self, protocol, port):
+        number = protocol if isinstance(protocol, int) else self.PROTOCOLS[str(protocol).lower()]
+        return (number << 16) + ((port or 0) if number in (6, 17, 132) else 0)
+
+    def _first(self, mask):
+        return self.rules[(mask & -mask).bit_length() - 1] if mask else None
+
+    # Lookups
+    def match(self, src, dst, protocol, port=None, srcintf=None, dstintf=None):
+        """
+        First rule matching a flow
+        :param src: Source ip address                                    eg. "10.0.0.5"
+        :param dst: Destination ip address                               eg. "8.8.8.8"
+        :param protocol: Protocol name or number                         eg. "tcp", 6
+        :param port: Destination port for tcp, udp and sctp              eg. 443
+        :param srcintf: Incoming interface, None matches any interface
+        :param dstintf: Outgoing interface, None matches any interface
+        :return: The matching rule as a dictionary, None when the flow hits the implicit deny
+        """
+        mask = self._segments["srcaddr"][1][self._segment("srcaddr", self._ip(src))]
+        mask &= self._segments["dstaddr"][1][self._segment("dstaddr", self._ip(dst))]
+        mask &= self._segments["service"][1][self._segment("service", self._service_key(protocol, port))]
+        mask &= self._interface_mask("srcintf", srcintf) & self._interface_mask("dstintf", dstintf)
+        return self._first(mask)
+
+    def match_many(self, flows):
+        """
+        First rule matching each flow. Flows falling in the same segments share one evaluation.
+        :param flows: Iterable of (src, dst, protocol, port) or (src, dst, protocol, port, srcintf, dstintf) tuples
+        :return: Generator of the matching rule or None, in the order of flows
+        """
+        masks = {field: self._segments[field][1] for field in ("srcaddr", "dstaddr", "service")}
+        cache = {}
+        for flow in flows:
+            src, dst, protocol, port = flow[:4]
+            srcintf, dstintf = (tuple(flow[4:6]) + (None, None))[:2]
+            key = (self._segment("srcaddr", self._ip(src)), self._segment("dstaddr", self._ip(dst)),
+                   self._segment("service", self._service_key(protocol, port)), srcintf, dstintf)
+            if key not in cache:
+                cache[key] = self._first(masks["srcaddr"][key[0]] & masks["dstaddr"][key[1]] &
+                                         masks["service"][key[2]] & self._interface_mask("srcintf", srcintf) &
+                                         self._interface_mask("dstintf", dstintf))
+            yield cache[key]
+
+    def _covering(self, field, ranges, cache):
+        """
+        Bitmask of the rules containing all the given ranges of a dimension
+        """
+        if ranges not in cache:
+            bounds, masks = self._segments[field]
+            mask = self._all
+            for low, high in ranges:
+                for segment in range(bisect.bisect_right(bounds, low) - 1, bisect.bisect_right(bounds, high)):
+                    mask &= masks[segment]
+                    if not mask:
+                        break
+            cache[ranges] = mask
+        return cache[ranges]
+
+    def shadowed(self):
+        """
+        Rules that can never match because a single earlier rule matches all their traffic
+        :return: List of dictionaries with policyid, name, covered_by (policyid of the earlier rule) and kind,
+                 "redundant" when both rules have the same action, "shadowed" otherwise
+        """
+        caches = {field: {} for field in ("srcaddr", "dstaddr", "service")}
+        results = []
+        for position, rule in enumerate(self.rules):
+            if rule["policyid"] in self.unresolved or not (rule["srcaddr"] and rule["dstaddr"] and rule["service"]):
+                continue
+            mask = (1 << position) - 1
+            for field in ("srcaddr", "dstaddr", "service"):
+                mask &= self._covering(field, rule[field], caches[field])
+            for field in ("srcintf", "dstintf"):
+                wildcard, names = self._interfaces[field]
+                if rule[field] is None:
+                    mask &= wildcard
+                else:
+                    for name in rule[field]:
+                        mask &= names[name]
+            cover = self._first(mask)
+            if cover is not None:
+                results.append({"policyid": rule["policyid"], "name": rule["name"], "covered_by": cover["policyid"],
+                                "kind": "redundant" if cover["action"] == rule["action"] else "shadowed"})
+        return results
+
+
+class Snapshot:
+    """
+    On-disk snapshot of the address objects, address groups, policy packages and policies of an adom.
+
+    The snapshot is a directory holding one JSON Lines file per table and a manifest.json recording, for each
+    table, the number of entries and the revision token it was read at. Packages carry an "obj ver" that
+    FortiManager increases on every change, so the policies of a package are only read again when its "obj ver"
+    moved since the last export. Object tables have no such token and are streamed page by page on every export.
+    Reads memory-map the files, so large tables are never loaded whole.
+
+    >>> snapshot = Snapshot("snapshots/root")
+    >>> snapshot.export(fortimngr)            # first run reads everything, next runs only what changed
+    >>> for policy in snapshot.iter("policy/default"): ...
+    >>> snapshot.restore(fortimngr, policy_package_name="default", dry_run=True)
+    """
+
+    MANIFEST = "manifest.json"
+    # Attributes set by FortiManager that are not sent back on restore
+    READ_ONLY_FIELDS = ("oid", "obj seq", "uuid")
+
+    def __init__(self, path):
+        self.path = path
+        self.manifest = {"adom": None, "tables": {}}
+        manifest = os.path.join(path, self.MANIFEST)
+        if os.path.exists(manifest):
+            with open(manifest, "rb") as file:
+                self.manifest = json_loads(file.read())
+
+    @property
+    def tables(self):
+        return sorted(self.manifest["tables"])
+
+    @staticmethod
+    def _file_name(table):
+        return re.sub(r"[^\w.-]", "_", table.replace("/", ".")) + ".jsonl"
+
+    @staticmethod
+    def _key(table, entry):
+        return entry.get("policyid") if table.startswith("policy/") else entry.get("name")
+
+    def iter(self, table):
+        """
+        Iterate over the entries of a table, eg. "address", "addrgrp", "package" or "policy/default"
+        """
+        if table not in self.manifest["tables"]:
+            raise KeyError(f"{table!r} is not in the snapshot")
+        path = os.path.join(self.path, self.manifest["tables"][table]["file"])
+        if os.path.getsize(path) == 0:
+            return
+        with open(path, "rb") as file, contextlib.closing(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)) \
+                as view:
+            for line in iter(view.readline, b""):
+                yield json_loads(line)
+
+    def load(self, table):
+        return list(self.iter(table))
+
+    def _digests(self, table):
+        """
+        Digest of every entry of a table of the current snapshot, by key
+        """
+        if table not in self.manifest["tables"]:
+            return {}
+        return {self._key(table, entry): hashlib.sha1(json_dumps(entry)).digest() for entry in self.iter(table)}
+
+    def _write(self, table, entries, token=None):
+        """
+        Stream entries to the file of a table and compare them with the previous snapshot
+        :return: Dictionary of counts: entries, added, updated, deleted
+        """
+        previous = self._digests(table)
+        name = self._file_name(table)
+        temporary = os.path.join(self.path, name + ".tmp")
+        counts = {"entries": 0, "added": 0, "updated": 0, "deleted": 0}
+        with open(temporary, "wb") as file:
+            for entry in entries:
+                line = json_dumps(entry)
+                digest = previous.pop(self._key(table, entry), None)
+                if digest is None:
+                    counts["added"] += 1
+                elif digest != hashlib.sha1(line).digest():
+                    counts["updated"] += 1
+                file.write(line + b"\n")
+                counts["entries"] += 1
+        counts["deleted"] = len(previous)
+        os.replace(temporary, os.path.join(self.path, name))
+        self.manifest["tables"][table] = {"file": name, "entries": counts["entries"], "token": token}
+        return counts
+
+    def _save_manifest(self):
+        temporary = os.path.join(self.path, self.MANIFEST + ".tmp")
+        with open(temporary, "wb") as file:
+            file.write(json_dumps(self.manifest))
+        os.replace(temporary, os.path.join(self.path, self.MANIFEST))
+
+    def export(self, fortimanager, page_size=1000):
+        """
+        Bring the snapshot up to date with the adom of fortimanager
+        :param page_size: Number of entries fetched per request
+        :return: Dictionary of table name to counts of entries, added, updated and deleted entries,
+                 None for the tables left untouched because their revision did not change
+        """
+        os.makedirs(self.path, exist_ok=True)
+        if self.manifest.get("adom") != fortimanager.adom:
+            self.manifest = {"adom": fortimanager.adom, "tables": {}}
+        report = {}
+        packages = FortiManagerError.check(fortimanager.get_policy_packages())[0].get("data") or []
+        report["package"] = self._write("package", packages)
+        report["address"] = self._write("address", fortimanager.iter_firewall_address_objects(page_size=page_size))
+        report["addrgrp"] = self._write("addrgrp", fortimanager.iter_address_groups(page_size=page_size))
+        names = set()
+        for package in packages:
+            if package.get("type", "pkg") != "pkg":
+                continue
+            table, token = f"policy/{package['name']}", package.get("obj ver")
+            names.add(table)
+            saved = self.manifest["tables"].get(table)
+            if token is not None and saved is not None and saved["token"] == token:
+                report[table] = None
+                continue
+            report[table] = self._write(table, fortimanager.iter_firewall_policies(package["name"],
+                                                                                   page_size=page_size), token)
+        for table in [table for table in self.manifest["tables"] if table.startswith("policy/")]:
+            if table not in names:
+                saved = self.manifest["tables"].pop(table)
+                os.remove(os.path.join(self.path, saved["file"]))
+                report[table] = {"entries": 0, "added": 0, "updated": 0, "deleted": saved["entries"]}
+        self.manifest["exported"] = time.time()
+        self._save_manifest()
+        return report
+
+    def _entries(self, table):
+        return [{field: value for field, value in entry.items()
+                 if field not in self.READ_ONLY_FIELDS and not field.startswith("_")} for entry in self.iter(table)]
+
+    def restore(self, fortimanager, policy_package_name="default", prune=False, dry_run=False, chunk_size=100):
+        """
+        Push the address objects, address groups and the policies of one package of the snapshot to fortimanager
+        :param prune: Also delete the entries that are not in the snapshot
+        :param dry_run: Only compute the changes, do not send them
+        :return: SyncPlan of the changes
+        """
+        desired = {"addresses": self._entries("address"), "groups": self._entries("addrgrp")}
+        if f"policy/{policy_package_name}" in self.manifest["tables"]:
+            desired["policies"] = self._entries(f"policy/{policy_package_name}")
+        engine = SyncEngine(fortimanager, policy_package_name=policy_package_name, chunk_size=chunk_size,
+                            prune=prune)
+        return engine.sync(desired, dry_run=dry_run)
+
+
+class AddressImporter:
+    """
+    Streaming import of address objects and address groups from a CSV or JSON Lines file.
+
+    Rows use FortiManager attribute names: name, type, subnet, start-ip, end-ip, fqdn, member, associated-interface
+    and comment. A row with members is a group, the members being a list in JSON Lines and separated by ";" in CSV.
+    Subnets are accepted as "10.0.0.0/24", "10.0.0.0 255.255.255.0" or a bare ip and sent as [address, netmask].
+
+    Address objects are sent while the file is read, in batched requests of chunk_size objects spread over
+    max_workers threads. Groups are sent once every object is created, a group after the groups it contains.
+    Every row gets a line in the report: ok, exists (already in FortiManager, kept as it is), error (refused by
+    FortiManager), invalid (rejected before sending) or skipped (a group whose member group could not be created).
+
+    >>> importer = AddressImporter(fortimngr, chunk_size=500, max_workers=4)
+    >>> importer.run("legacy_objects.csv", report_path="import_report.csv")
+    {'ok': 199870, 'exists': 0, 'error': 12, 'invalid': 118, 'skipped': 0}
+    """
+
+    REPORT_FIELDS = ("line", "name", "kind", "status", "message")
+    # Status code of an add refused because the object already exists
+    EXISTS_CODE = -2
+    # Longest object name FortiManager accepts
+    MAX_NAME_LENGTH = 79
+    TYPES = {"ipmask": 0, "iprange": 1, "fqdn": 2}
+
+    def __init__(self, fortimanager, chunk_size=500, max_workers=4, update_existing=False):
+        """
+        :param chunk_size: Maximum number of objects sent in a single request
+        :param max_workers: Number of requests in flight at the same time
+        :param update_existing: Overwrite the objects and groups that already exist instead of keeping them
+        """
+        self.fortimanager = fortimanager
+        self.chunk_size = chunk_size
+        self.max_workers = max_workers
+        self.update_existing = update_existing
+
+    @staticmethod
+    def read(path):
+        """
+        Yield (line number, row) for each row of a CSV (.csv) or JSON Lines file.
+        JSON Lines rows are yielded as text, and decoded with decode() so one bad line only fails its own row
+        """
+        with open(path, newline="", encoding="utf-8") as file:
+            if path.lower().endswith(".csv"):
+                reader = csv.DictReader(file)
+                for row in reader:
+                    yield reader.line_num, {key: value for key, value in row.items()
+                                            if key and value not in ("", None)}
+                return
+            for number, line in enumerate(file, 1):
+                if line.strip():
+                    yield number, line
+
+    @staticmethod
+    def decode(row):
+        """
+        Decode a JSON Lines row yielded by read(). CSV rows are returned as they are
+        :return: Dictionary of attributes
+        """
+        if isinstance(row, str):
+            row = json_loads(row)
+        if not isinstance(row, dict):
+            raise ValueError(f"row is a {type(row).__name__}, not an object")
+        return row
+
+    @classmethod
+    def normalize(cls, row):
+        """
+        Validate a row and convert it to the data FortiManager expects
+        :return: ("address" or "group", data)
+        :raise ValueError: When the row is not valid
+        """
+        name = str(row.get("name") or "").strip()
+        if not name:
+            raise ValueError("name is missing")
+        if len(name) > cls.MAX_NAME_LENGTH:
+            raise ValueError(f"name is longer than {cls.MAX_NAME_LENGTH} characters")
+        data = {"name": name}
+        for field in ("associated-interface", "comment"):
+            if row.get(field):
+                data[field] = row[field]
+        members = row.get("member")
+        if members or row.get("type") == "group":
+            if isinstance(members, str):
+                members = [member.strip() for member in members.split(";")]
+            members = [member for member in members or [] if member]
+            if not members:
+                raise ValueError("group has no member")
+            data.pop("associated-interface", None)
+            data["member"] = members
+            return "group", data
+        object_type = row.get("type")
+        if object_type in (None, ""):
+            object_type = "iprange" if row.get("start-ip") else "fqdn" if row.get("fqdn") else "ipmask"
+        numbers = {str(number): type_name for type_name, number in cls.TYPES.items()}
+        object_type = numbers.get(str(object_type), object_type)
+        if object_type not in cls.TYPES:
+            raise ValueError(f"unsupported type {object_type!r}")
+        data["type"] = cls.TYPES[object_type]
+        if object_type == "ipmask":
+            subnet = row.get("subnet")
+            if isinstance(subnet, (list, tuple)):
+                subnet = "/".join(subnet)
+            if not subnet:
+                raise ValueError("subnet is missing")
+            network = ipaddress.IPv4Network(" ".join(str(subnet).split()).replace(" ", "/"), strict=False)
+            data["subnet"] = [str(network.network_address), str(network.netmask)]
+        elif object_type == "iprange":
+            start = ipaddress.IPv4Address(str(row.get("start-ip", "")).strip())
+            end = ipaddress.IPv4Address(str(row.get("end-ip", "")).strip())
+            if start > end:
+                raise ValueError("start-ip is after end-ip")
+            data["start-ip"], data["end-ip"] = str(start), str(end)
+        else:
+            if not row.get("fqdn"):
+                raise ValueError("fqdn is missing")
+            data["fqdn"] = str(row["fqdn"]).strip()
+        return "address", data
+
+    @staticmethod
+    def _levels(groups):
+        """
+        Split groups into levels, each group coming after the groups it contains
+        :param groups: Dictionary of name to (line, data)
+        :return: (list of lists of names, list of names of the groups that contain themselves)
+        """
+        levels, cyclic = {}, []
+
+        def level(name, path):
+            if name in levels:
+                return levels[name]
+            if name in path:
+                raise ValueError(name)
+            path.add(name)
+            members = [member for member in groups[name][1]["member"] if member in groups]
+            levels[name] = 1 + max((level(member, path) for member in members), default=-1)
+            path.discard(name)
+            return levels[name]
+
+        for name in groups:
+            try:
+                level(name, set())
+            except ValueError:
+                cyclic.append(name)
+        ordered = [[] for _ in range(max(levels.values(), default=-1) + 1)]
+        for name, depth in levels.items():
+            ordered[depth].append(name)
+        return ordered, cyclic
+
+    def _send(self, kind, rows):
+        """
+        Send a chunk of rows in one batched request
+        :return: List of (line, name, status, message)
+        """
+        table = "address" if kind == "address" else "addrgrp"
+        url = f"pm/config/adom/{self.fortimanager.adom}/obj/firewall/{table}"
+        method = "set" if self.update_existing else "add"
+        batch = self.fortimanager.batch(chunk_size=self.chunk_size)
+        calls = [batch.queue(method, url, data=data) for _, data in rows]
+        try:
+            batch.execute()
+        except Exception as error:
+            return [(line, data["name"], "error", str(error)) for line, data in rows]
+        results = []
+        for (line, data), call in zip(rows, calls):
+            status = call.result[0].get("status", {}) if call.result else {}
+            if status.get("code", 0) == 0:
+                results.append((line, data["name"], "ok", ""))
+            elif status.get("code") == self.EXISTS_CODE:
+                # The object is there, so the groups using it can still be created
+                results.append((line, data["name"], "exists", status.get("message", "")))
+            else:
+                results.append((line, data["name"], "error", f"{status.get('message')} (code {status.get('code')})"))
+        return results
+
+    def run(self, path, report_path=None):
+        """
+        Import a file
+        :param path: CSV (.csv) or JSON Lines file
+        :param report_path: Write the outcome of every row to this file, as CSV when it ends with .csv and as
+                            JSON Lines otherwise
+        :return: Dictionary of status to number of rows
+        """
+        summary = {"ok": 0, "exists": 0, "error": 0, "invalid": 0, "skipped": 0}
+        failed = set()
+        with contextlib.ExitStack() as stack:
+            report = None
+            if report_path:
+                file = stack.enter_context(open(report_path, "w", newline="", encoding="utf-8"))
+                if report_path.lower().endswith(".csv"):
+                    writer = csv.writer(file)
+                    writer.writerow(self.REPORT_FIELDS)
+                    report = writer.writerow
+                else:
+                    def report(values):
+                        file.write(json_dumps(dict(zip(self.REPORT_FIELDS, values))).decode("utf-8") + "\n")
+
+            names, groups, chunk = set(), {}, []
+
+            def record(line, name, kind, status, message=""):
+                summary[status] += 1
+                # A row repeating the name of a valid row does not make that object fail
+                if status in ("error", "skipped") or status == "invalid" and name not in names:
+                    failed.add(name)
+                if report is not None:
+                    report((line, name, kind, status, message))
+
+            executor = stack.enter_context(ThreadPoolExecutor(max_workers=self.max_workers))
+            pending = []
+
+            def submit(kind, rows):
+                pending.append((kind, executor.submit(self._send, kind, rows)))
+
+            def drain(limit=0):
+                while len(pending) > limit:
+                    kind, future = pending.pop(0)
+                    for line, name, status, message in future.result():
+                        record(line, name, kind, status, message)
+
+            for line, row in self.read(path):
+                try:
+                    row = self.decode(row)
+                    kind, data = self.normalize(row)
+                    if data["name"] in names:
+                        raise ValueError("name appears more than once in the file")
+                except (TypeError, ValueError) as error:
+                    if not isinstance(row, dict):
+                        row = {}
+                    record(line, row.get("name"), "group" if row.get("member") else "address", "invalid", str(error))
+                    continue
+                names.add(data["name"])
+                if kind == "group":
+                    groups[data["name"]] = (line, data)
+                    continue
+                chunk.append((line, data))
+                if len(chunk) >= self.chunk_size:
+                    submit("address", chunk)
+                    chunk = []
+                    # Keep a bounded number of chunks in memory while the file is read
+                    drain(limit=2 * self.max_workers)
+            if chunk:
+                submit("address", chunk)
+            drain()
+
+            levels, cyclic = self._levels(groups)
+            for name in cyclic:
+                record(groups[name][0], name, "group", "invalid", "group contains itself")
+            for level in levels:
+                rows = []
+                for name in level:
+                    line, data = groups[name]
+                    missing = [member for member in data["member"] if member in failed]
+                    if missing:
+                        record(line, name, "group", "skipped", f"members not created: {', '.join(missing)}")
+                    else:
+                        rows.append((line, data))
+                for start in range(0, len(rows), self.chunk_size):
+                    submit("group", rows[start:start + self.chunk_size])
+                drain()
+        return summary
+
+
+class ReferenceGraph:
+    """
+    Where-used index of the address objects and address groups of an adom, built from one bulk read.
+
+    Records which groups (members and excluded members) and which policies (source and destination addresses) use
+    each object or group. Only these references are known: an object used elsewhere, eg. by a VIP or a central
+    NAT rule, looks unused and FortiManager refuses its deletion, which is reported as an error.
+
+    >>> graph = ReferenceGraph.from_fortimanager(fortimngr)
+    >>> graph.where_used("HOST_10.0.0.1", recursive=True)
+    >>> graph.unused()
+    >>> graph.delete_unused(fortimngr, dry_run=True)
+
+    The predefined objects in KEEP, and the names given with keep=, are never reported unused or deleted.
+    """
+
+    GROUP_FIELDS = ("member", "exclude-member")
+    POLICY_FIELDS = ("srcaddr", "dstaddr")
+    # Predefined objects and groups of a new adom, never deleted
+    KEEP = ("all", "none", "FABRIC_DEVICE", "FIREWALL_AUTH_PORTAL_ADDRESS", "SSLVPN_TUNNEL_ADDR1", "gmail.com",
+            "wildcard.google.com", "wildcard.dropbox.com", "login.microsoft.com", "login.microsoftonline.com",
+            "login.windows.net", "Microsoft Office 365", "G Suite")
+
+    def __init__(self, addresses=(), groups=(), policies=None, keep=()):
+        """
+        :param addresses: Address objects, only their names are used
+        :param groups: Address groups
+        :param policies: Dictionary of policy package name to list of policies
+        :param keep: Names never reported unused or deleted, on top of KEEP
+        """
+        self.keep = set(self.KEEP).union(keep)
+        self.addresses = {entry["name"] for entry in addresses}
+        self.groups = {}
+        self.used_by = {}
+        for group in groups:
+            members = [name for field in self.GROUP_FIELDS for name in self._names(group.get(field))]
+            self.groups[group["name"]] = members
+            for member in members:
+                self.used_by.setdefault(member, set()).add(("group", group["name"]))
+        for package, rules in (policies or {}).items():
+            for rule in rules:
+                for field in self.POLICY_FIELDS:
+                    for name in self._names(rule.get(field)):
+                        self.used_by.setdefault(name, set()).add(("policy", package, rule.get("policyid")))
+
+    @staticmethod
+    def _names(value):
+        if not value:
+            return []
+        return [value] if isinstance(value, str) else list(value)
+
+    @classmethod
+    def from_fortimanager(cls, fortimanager, packages=None, chunk_size=100, keep=()):
+        """
+        Read the address objects, address groups and the policies of every package with one batched request
+        :param packages: Only index the policies of these packages. Default is every package of the adom
+        :param keep: Names never reported unused or deleted, on top of KEEP
+        """
+        adom = fortimanager.adom
+        if packages is None:
+            result = FortiManagerError.check(fortimanager.get_policy_packages(fields=["name", "type"]))
+            packages = [package["name"] for package in result[0].get("data") or []
+                        if package.get("type", "pkg") == "pkg"]
+        batch = fortimanager.batch(chunk_size=chunk_size)
+        addresses = batch.queue("get", f"pm/config/adom/{adom}/obj/firewall/address", fields=["name"])
+        groups = batch.queue("get", f"pm/config/adom/{adom}/obj/firewall/addrgrp",
+                             fields=["name"] + list(cls.GROUP_FIELDS))
+        policies = {package: batch.queue("get", f"pm/config/adom/{adom}/pkg/{package}/firewall/policy",
+                                         fields=["policyid", "name"] + list(cls.POLICY_FIELDS))
+                    for package in packages}
+        batch.execute()
+
+        def data(call):
+            return FortiManagerError.check(call.result)[0].get("data") or []
+
+        return cls(data(addresses), data(groups), {package: data(call) for package, call in policies.items()},
+                   keep=keep)
+
+    def where_used(self, name, recursive=False):
+        """
+        Groups and policies using an object or a group
+        :param recursive: Also follow the groups using it, up to the policies using those groups
+        :return: Sorted list of ("group", name) and ("policy", package, policyid) references
+        """
+        references, stack, seen = set(), [name], {name}
+        while stack:
+            for reference in self.used_by.get(stack.pop(), ()):
+                references.add(reference)
+                if recursive and reference[0] == "group" and reference[1] not in seen:
+                    seen.add(reference[1])
+                    stack.append(reference[1])
+        return sorted(references, key=str)
+
+    def unused(self, cascade=False):
+        """
+        Objects and groups no group or policy uses
+        :param cascade: Also include what is only used by unused groups, ie. everything no policy reaches
+        :return: Set of names
+        """
+        names = (self.addresses | set(self.groups)).difference(self.keep)
+        if not cascade:
+            return {name for name in names if not self.used_by.get(name)}
+        reached = set(self.keep)
+        stack = [name for name, references in self.used_by.items()
+                 if any(reference[0] == "policy" for reference in references)]
+        while stack:
+            name = stack.pop()
+            if name in reached:
+                continue
+            reached.add(name)
+            stack.extend(self.groups.get(name, ()))
+        return names - reached
+
+    def delete_order(self, names):
+        """
+        Order names so that a group is deleted before the groups and objects it contains
+        """
+        names = set(names)
+        groups = [{"name": name, "member": self.groups[name]} for name in self.groups if name in names]
+        ordered = [group["name"] for group in reversed(SyncEngine._group_order(groups))]
+        return ordered + sorted(names.difference(self.groups))
+
+    def remove(self, name):
+        """
+        Drop a deleted object or group from the graph
+        """
+        self.addresses.discard(name)
+        for member in self.groups.pop(name, ()):
+            references = self.used_by.get(member)
+            if references is not None:
+                references.discard(("group", name))
+                if not references:
+                    del self.used_by[member]
+
+    def delete_unused(self, fortimanager, cascade=False, dry_run=False, chunk_size=100):
+        """
+        Delete the unused objects and groups with batched requests, groups before their members
+        :param cascade: Also delete what is only used by unused groups. Check the names with dry_run=True first
+        :param dry_run: Only return the names that would be deleted, in order
+        :return: Dictionary with the "deleted" names and the "errors" by name
+        """
+        names = self.delete_order(self.unused(cascade=cascade))
+        if dry_run:
+            return {"deleted": names, "errors": {}}
+        batch = fortimanager.batch(chunk_size=chunk_size)
+        calls = [(name, batch.delete_address_group(name) if name in self.groups
+                  else batch.delete_firewall_address_object(name)) for name in names]
+        batch.execute()
+        report = {"deleted": [], "errors": {}}
+        for name, call in calls:
+            status = call.result[0].get("status", {})
+            if status.get("code", 0) == 0:
+                report["deleted"].append(name)
+                self.remove(name)
+            else:
+                report["errors"][name] = f"{status.get('message')} (code {status.get('code')})"
+        return report
+
+
+class FortiManagerFleet:
+    """
+    Client for several FortiManager appliances, each one a single host or an HA cluster of hosts.
+
+    One FortiManager instance is kept per host, with its own login session, connection pool and a concurrency
+    limit of max_per_host requests in flight. Calls are routed by adom or by appliance name to the active host of
+    the appliance. When that host cannot be reached, the call is sent again to the next host of the cluster, which
+    becomes the active one. Only calls whose connection could not be opened fail over, so a write is never sent
+    twice.
+
+    >>> fleet = FortiManagerFleet({"emea": ["fmg-emea-1", "fmg-emea-2"], "apac": "fmg-apac"},
+    ...                           username="api", password="...", adoms={"emea": ["EU_*"]})
+    >>> fleet.for_adom("EU_PARIS").get_firewall_policies("default")
+    >>> fleet.for_appliance("apac").get_adoms()
+    >>> fleet.fan_out("get_firewall_address_objects", fields=["name", "subnet"])
+    """
+
+    def __init__(self, appliances, username="admin", password="admin", adoms=None, max_per_host=10, **options):
+        """
+        :param appliances: Dictionary of appliance name to host, or to the list of hosts of an HA cluster
+        :param adoms: Dictionary of appliance name to the adoms it manages, as names or patterns eg. ["EU_*"].
+                      Adoms matching no pattern are looked up with get_adoms() on every appliance
+        :param max_per_host: Maximum number of requests in flight per host
+        :param options: Other FortiManager arguments eg. verify, timeout, max_retries, cache_ttl
+        """
+        self.appliances = {name: [hosts] if isinstance(hosts, str) else list(hosts)
+                           for name, hosts in appliances.items()}
+        self.username = username
+        self.password = password
+        self.patterns = dict(adoms or {})
+        self.max_per_host = max_per_host
+        self.options = options
+        self._clients = {}
+        self._active = {name: 0 for name in self.appliances}
+        self._adoms = None
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """
+        Logout from every host and release the pooled connections
+        """
+        with self._lock:
+            clients, self._clients = list(self._clients.values()), {}
+        for client in clients:
+            client.close()
+
+    def client(self, host):
+        """
+        FortiManager instance of a host, created on first use
+        """
+        with self._lock:
+            if host not in self._clients:
+                limiter = AdaptiveConcurrencyLimiter(initial=self.max_per_host, maximum=self.max_per_host)
+                self._clients[host] = FortiManager(host, username=self.username, password=self.password,
+                                                   pool_maxsize=self.max_per_host, concurrency_limiter=limiter,
+                                                   **self.options)
+            return self._clients[host]
+
+    def active_hosts(self):
+        """
+        :return: Dictionary of appliance name to the host calls are sent to
+        """
+        return {name: hosts[self._active[name]] for name, hosts in self.appliances.items()}
+
+    def run(self, appliance, function):
+        """
+        Call function with the FortiManager of the active host of an appliance, failing over to the other hosts
+        of the cluster when the host cannot be reached
+        :return: What function returns
+        """
+        hosts = self.appliances[appliance]
+        for attempt in range(len(hosts)):
+            index = self._active[appliance]
+            try:
+                return function(self.client(hosts[index]))
+            except requests.exceptions.RequestException as error:
+                if not _unreachable(error) or attempt == len(hosts) - 1:
+                    raise
+                with self._lock:
+                    if self._active[appliance] == index:
+                        self._active[appliance] = (index + 1) % len(hosts)
+
+    def adoms(self, refresh=False):
+        """
+        Adoms of every appliance, read once with get_adoms()
+        :return: Dictionary of appliance name to list of adom names
+        """
+        if self._adoms is None or refresh:
+            def names(client):
+                return [adom["name"] for adom in FortiManagerError.check(client.get_adoms(fields=["name"]))[0]["data"]]
+
+            with ThreadPoolExecutor(max_workers=len(self.appliances)) as executor:
+                futures = {name: executor.submit(self.run, name, names) for name in self.appliances}
+                self._adoms = {name: future.result() for name, future in futures.items()}
+        return self._adoms
+
+    def route(self, adom):
+        """
+        :return: Name of the appliance managing an adom
+        :raise KeyError: When no appliance manages it
+        """
+        for name, patterns in self.patterns.items():
+            if any(fnmatch.fnmatchcase(adom, pattern) for pattern in patterns):
+                return name
+        for name, adoms in self.adoms().items():
+            if adom in adoms:
+                return name
+        raise KeyError(f"no appliance manages adom {adom!r}")
+
+    def for_adom(self, adom):
+        """
+        :return: FleetView calling the appliance managing the adom
+        """
+        return FleetView(self, self.route(adom), adom)
+
+    def for_appliance(self, appliance, adom=None):
+        """
+        :param adom: Adom the calls work on. Default is the adom given in options, else "root"
+        :return: FleetView calling the appliance
+        """
+        if appliance not in self.appliances:
+            raise KeyError(f"unknown appliance {appliance!r}")
+        return FleetView(self, appliance, adom)
+
+    def fan_out(self, method, appliances=None, adoms=None, max_workers=32, **kwargs):
+        """
+        Run the same read on many adoms of many appliances concurrently, at most max_per_host requests per host
+        :param method: Name of a FortiManager method or a callable taking the per adom FortiManager view
+        :param appliances: Names of the appliances to query. Default is every appliance
+        :param adoms: Names of the adoms to query. Default is every adom of the appliances
+        :param max_workers: Number of adoms queried at the same time across the fleet
+        :param kwargs: Keyword arguments passed to the method
+        :return: FanOutResult with the results and the errors keyed by (appliance, adom)
+        """
+        names = list(self.appliances) if appliances is None else list(appliances)
+        if adoms is None:
+            targets = [(name, adom) for name in names for adom in self.adoms()[name]]
+        else:
+            targets = [(self.route(adom), adom) for adom in adoms]
+            targets = [(name, adom) for name, adom in targets if name in names]
+
+        def run(target):
+            def call(client):
+                view = client.for_adom(target[1])
+                if callable(method):
+                    return method(view, **kwargs)
+                return FortiManagerError.check(getattr(view, method)(**kwargs))
+
+            return self.run(target[0], call)
+
+        outcome = FanOutResult()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {target: executor.submit(run, target) for target in targets}
+            for target, future in futures.items():
+                try:
+                    outcome.results[target] = future.result()
+                except Exception as error:
+                    outcome.errors[target] = error
+        return outcome
+
+
+class FleetView:
+    """
+    Offers the FortiManager methods for one appliance of a FortiManagerFleet, and optionally one adom.
+    Each call goes to the active host of the appliance and fails over like FortiManagerFleet.run().
+    """
+
+    def __init__(self, fleet, appliance, adom=None):
+        self.fleet = fleet
+        self.appliance = appliance
+        self.adom = adom
+
+    def __repr__(self):
+        return f"FleetView(appliance={self.appliance!r}, adom={self.adom!r})"
+
+    def __getattr__(self, name):
+        if name.startswith("_") or not callable(getattr(FortiManager, name, None)):
+            raise AttributeError(name)
+
+        def call(*args, **kwargs):
+            def method(client):
+                view = client if self.adom is None else client.for_adom(self.adom)
+                return getattr(view, name)(*args, **kwargs)
+
+            return self.fleet.run(self.appliance, method)
+
+        call.__name__ = name
+        return call
+
+
+class Record:
+    """
+    Compact form of a FortiManager table entry, for holding large tables in memory.
+
+    The attributes listed in FIELDS are decoded when the record is built and kept in slots, strings interned and
+    lists turned into tuples, so that names repeated across entries (members, interfaces, netmasks) are stored
+    once. The other attributes are kept together as one JSON encoded bytes string and decoded when read.
+    Attributes are read with "-" and " " replaced by "_", eg. record.associated_interface, or with the keyword
+    names of make_data(), eg. policy.source_address.
+
+    >>> addresses = AddressRecord.from_result(fortimngr.get_firewall_address_objects())
+    >>> policies = [PolicyRecord(entry) for entry in fortimngr.iter_firewall_policies("default")]
+    >>> addresses[0].subnet, addresses[0].comment
+    >>> fortimngr.update_firewall_address_object(record.name, **record.to_kwargs())
+    """
+
+    __slots__ = ("_extra",)
+    # FortiManager attributes decoded eagerly, one slot each
+    FIELDS = ()
+    # Keyword arguments of make_data() and the FortiManager attributes they stand for
+    MAPS = {}
+    _attributes = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._attributes = tuple(cls._attribute(field) for field in cls.FIELDS)
+
+    def __init__(self, entry):
+        """
+        :param entry: Entry as returned by FortiManager
+        """
+        extra = dict(entry)
+        for field, attribute in zip(self.FIELDS, self._attributes):
+            setattr(self, attribute, self._compact(extra.pop(field, None)))
+        # orjson over-allocates the bytes it returns, which would defeat the purpose here
+        self._extra = _json_encoder.encode(extra).encode("utf-8") if extra else None
+
+    @staticmethod
+    def _attribute(field):
+        return field.replace("-", "_").replace(" ", "_")
+
+    @classmethod
+    def _compact(cls, value):
+        if isinstance(value, str):
+            return sys.intern(value)
+        if isinstance(value, list):
+            return tuple(cls._compact(item) for item in value)
+        return value
+
+    @classmethod
+    def _expand(cls, value):
+        if isinstance(value, tuple):
+            return [cls._expand(item) for item in value]
+        return value
+
+    @classmethod
+    def from_result(cls, result):
+        """
+        Records of the entries of a get response
+        :param result: Response of status code with data in JSON Format
+        :return: List of records
+        """
+        data = FortiManagerError.check(result)[0].get("data") or []
+        return [cls(entry) for entry in ([data] if isinstance(data, dict) else data)]
+
+    @classmethod
+    def from_kwargs(cls, **kwargs):
+        """
+        Build a record from the keyword arguments of make_data() eg. PolicyRecord.from_kwargs(source_address="LAN")
+        """
+        return cls({cls.MAPS[keyword]: value for keyword, value in kwargs.items()})
+
+    @property
+    def extra(self):
+        """
+        The attributes that are not in FIELDS, decoded
+        """
+        return json_loads(self._extra) if self._extra else {}
+
+    def __getattr__(self, name):
+        # Only called for the attributes that are not slots
+        if name.startswith("_"):
+            raise AttributeError(name)
+        if name in self.MAPS and self.MAPS[name] in self.FIELDS:
+            return getattr(self, self._attribute(self.MAPS[name]))
+        extra = self.extra
+        for field in (self.MAPS.get(name), name, name.replace("_", "-"), name.replace("_", " ")):
+            if field in extra:
+                return extra[field]
+        raise AttributeError(name)
+
+    def to_dict(self):
+        """
+        The entry with FortiManager attribute names
+        """
+        data = {}
+        for field, attribute in zip(self.FIELDS, self._attributes):
+            value = getattr(self, attribute)
+            if value is not None:
+                data[field] = self._expand(value)
+        data.update(self.extra)
+        return data
+
+    def to_kwargs(self):
+        """
+        The attributes having a make_data() keyword, with those keywords
+        """
+        data = self.to_dict()
+        return {keyword: data[field] for keyword, field in self.MAPS.items() if field in data}
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.to_dict() == other.to_dict()
+
+    def __repr__(self):
+        values = ", ".join(f"{attribute}={getattr(self, attribute)!r}" for attribute in self._attributes
+                           if getattr(self, attribute) is not None)
+        return f"{type(self).__name__}({values})"
+
+
+class AddressRecord(Record):
+    __slots__ = ("name", "type", "subnet", "start_ip", "end_ip", "associated_interface")
+    FIELDS = ("name", "type", "subnet", "start-ip", "end-ip", "associated-interface")
+    MAPS = OBJECT_MAPS
+
+
+class AddressGroupRecord(Record):
+    __slots__ = ("name", "member")
+    FIELDS = ("name", "member")
+    # Keyword arguments of add_address_group()
+    MAPS = {"name": "name", "members": "member"}
+
+
+class PolicyRecord(Record):
+    __slots__ = ("policyid", "name", "status", "action", "srcintf", "dstintf", "srcaddr", "dstaddr", "service",
+                 "schedule")
+    FIELDS = ("policyid", "name", "status", "action", "srcintf", "dstintf", "srcaddr", "dstaddr", "service",
+              "schedule")
+    MAPS = POLICY_MAPS
+
+
+class PackageRecord(Record):
+    __slots__ = ("name", "type", "obj_ver")
+    FIELDS = ("name", "type", "obj ver")
+    MAPS = {"name": "name"}
+
+
+class DeviceMonitor:
+    """
+    Polls the status of the devices managed in an adom and reports the devices whose status changed.
+
+    Each poll reads the status attributes of every device page by page, so 3,000 devices cost a few requests.
+    The full details of devices are read on demand, in batched requests spread over max_workers threads.
+
+    >>> monitor = DeviceMonitor(fortimngr)
+    >>> monitor.poll()              # every device on the first poll, then only what changed
+    {'FGT-00042': {'conn_status': ('up', 'down')}}
+    >>> print(monitor.format_table())
+    >>> monitor.unhealthy()         # devices that are down or out of sync, eg. before installing a package
+    """
+
+    STATUS_FIELDS = ("conn_status", "conf_status", "db_status", "dev_status")
+    FIELDS = ("name", "sn", "ip", "platform_str", "os_ver", "mr", "patch", "build", "ha_mode") + STATUS_FIELDS
+    # Names of the numeric states FortiManager returns
+    STATES = {
+        "conn_status": {0: "unknown", 1: "up", 2: "down"},
+        "conf_status": {0: "unknown", 1: "insync", 2: "outofsync"},
+        "db_status": {0: "unknown", 1: "nomod", 2: "mod"},
+    }
+    COLUMNS = ("name", "ip", "platform", "version", "conn", "conf", "db")
+
+    def __init__(self, fortimanager, page_size=1000, max_workers=10, chunk_size=100):
+        """
+        :param page_size: Number of devices read per request when polling
+        :param max_workers: Number of requests in flight when reading device details
+        :param chunk_size: Number of devices whose details are read per request
+        """
+        self.fortimanager = fortimanager
+        self.page_size = page_size
+        self.max_workers = max_workers
+        self.chunk_size = chunk_size
+        self.devices = {}
+
+    @classmethod
+    def _state(cls, field, value):
+        return cls.STATES.get(field, {}).get(value, value)
+
+    def _compact(self, device):
+        return {field: self._state(field, device.get(field)) for field in self.FIELDS}
+
+    def poll(self):
+        """
+        Read the status of every device and compare it with the previous poll
+        :return: Dictionary of device name to {attribute: (old value, new value)} for the devices added, removed
+                 or whose attributes changed
+        """
+        current = {device["name"]: self._compact(device)
+                   for device in self.fortimanager.iter_devices(page_size=self.page_size, fields=list(self.FIELDS))}
+        changes = {}
+        for name in sorted(current.keys() | self.devices.keys()):
+            old, new = self.devices.get(name, {}), current.get(name, {})
+            changed = {field: (old.get(field), new.get(field)) for field in self.FIELDS
+                       if field != "name" and old.get(field) != new.get(field)}
+            if changed:
+                changes[name] = changed
+        self.devices = current
+        return changes
+
+    def details(self, names=None):
+        """
+        Full details of devices, read concurrently
+        :param names: Names of the devices. Default is every device of the last poll
+        :return: Dictionary of device name to device, None for the devices FortiManager did not return
+        """
+        names = sorted(self.devices) if names is None else list(names)
+        adom = self.fortimanager.adom
+
+        def read(chunk):
+            batch = self.fortimanager.batch(chunk_size=self.chunk_size)
+            calls = [batch.queue("get", f"dvmdb/adom/{adom}/device/{name}") for name in chunk]
+            batch.execute()
+            return {name: call.result[0].get("data") if call.result[0].get("status", {}).get("code", 0) == 0
+                    else None for name, call in zip(chunk, calls)}
+
+        chunks = [names[start:start + self.chunk_size] for start in range(0, len(names), self.chunk_size)]
+        self.fortimanager.login()
+        details = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for result in executor.map(read, chunks):
+                details.update(result)
+        return details
+
+    def unhealthy(self):
+        """
+        :return: Names of the devices of the last poll that are not connected or whose configuration is not in sync
+        """
+        return sorted(name for name, device in self.devices.items()
+                      if device["conn_status"] != "up" or device["conf_status"] != "insync")
+
+    def table(self, names=None):
+        """
+        Status of devices as rows of COLUMNS
+        :param names: Names of the devices. Default is every device of the last poll
+        :return: List of tuples
+        """
+        rows = []
+        for name in sorted(self.devices) if names is None else names:
+            device = self.devices[name]
+            version = ".".join(str(device[field]) for field in ("os_ver", "mr", "patch") if device[field] is not None)
+            if device["build"] is not None:
+                version = f"{version} build {device['build']}"
+            rows.append((name, device["ip"], device["platform_str"], version, device["conn_status"],
+                         device["conf_status"], device["db_status"]))
+        return rows
+
+    def format_table(self, names=None):
+        """
+        Status of devices as aligned text, one line per device
+        """
+        rows = [self.COLUMNS] + [tuple("" if value is None else str(value) for value in row)
+                                 for row in self.table(names)]
+        widths = [max(len(row[column]) for row in rows) for column in range(len(self.COLUMNS))]
+        return "\n".join("  ".join(value.ljust(width) for value, width in zip(row, widths)).rstrip() for row in rows)
@@ -0,0 +1,448 @@
+"""
+Local stand-in for the FortiManager JSON-RPC API, for testing and benchmarking pyFortiManagerAPI without an appliance.
+
+It serves the urls used by pyFortiManagerAPI.FortiManager from an in-memory dataset:
+sys/login/user, sys/logout, dvmdb/adom, dvmdb devices, pm/pkg, pm/config address objects, address groups,
+services, service groups and policies, workspace lock/commit/unlock, securityconsole/install/package and task/task.
+
+>>> with MockFortiManager(addresses=10000, policies=5000, latency=0.002) as server:
+...     fortimngr = FortiManager(host=server.host)
+...     fortimngr.get_firewall_address_objects(fields=["name"])
+"""
+
+__author__ = "Akshay Mane"
+
+import copy
+import fnmatch
+import ipaddress
+import itertools
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+OK = {"code": 0, "message": "OK"}
+NOT_FOUND = {"code": -3, "message": "Object does not exist"}
+DUPLICATE = {"code": -2, "message": "Object already exists"}
+INVALID_URL = {"code": -6, "message": "Invalid url"}
+NO_PERMISSION = {"code": -11, "message": "No permission for the resource"}
+LOCKED = {"code": -10147, "message": "Workspace is locked by another session"}
+NOT_LOCKED = {"code": -10148, "message": "Workspace is not locked"}
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        try:
+            request = json.loads(body)
+        except ValueError:
+            request = None
+        data = self.server.mock.handle(request)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class MockFortiManager:
+    """
+    In-memory FortiManager JSON-RPC server running on a background thread
+
+    :param adoms: Number of adoms. The first one is "root", the others "adom1", "adom2"...
+    :param packages: Number of policy packages per adom. The first one is "default"
+    :param addresses: Number of address objects per adom
+    :param groups: Number of address groups per adom, each with up to 10 address objects as members
+    :param policies: Number of policies per package
+    :param devices: Number of managed devices per adom
+    :param latency: Seconds added to every request, to mimic the network and the appliance
+    :param install_duration: Seconds an install task takes to reach 100%
+    :param workspace_mode: Refuse writes to an adom unless the session holds its workspace lock. Changes not
+                           committed when the adom is unlocked are discarded
+    :param username: Accepted user name
+    :param password: Accepted password
+    :param port: Port to listen on. Default is any free port
+    """
+
+    def __init__(self, adoms=1, packages=1, addresses=1000, groups=100, policies=1000, devices=100, latency=0.0,
+                 install_duration=0.5, workspace_mode=False, username="admin", password="admin", port=0):
+        self.latency = latency
+        self.install_duration = install_duration
+        self.workspace_mode = workspace_mode
+        self.locks = {}
+        self.commits = 0
+        self._uncommitted = {}
+        self.username = username
+        self.password = password
+        self.port = port
+        self.sessions = set()
+        self.requests = 0
+        self._tasks = {}
+        self._task_ids = itertools.count(1)
+        self._lock = threading.RLock()
+        self._server = None
+        self.adoms = {}
+        for index in range(adoms):
+            self.adoms["root" if index == 0 else f"adom{index}"] = self._dataset(packages, addresses, groups,
+                                                                                  policies, devices)
+
+    @staticmethod
+    def _dataset(packages, addresses, groups, policies, devices=0):
+        network = ipaddress.ip_network("10.0.0.0/8")
+        address_table = {}
+        for index in range(addresses):
+            host = str(network[index + 1])
+            address_table[f"HOST_{host}"] = {"name": f"HOST_{host}", "type": 0, "subnet": [host, "255.255.255.255"],
+                                             "associated-interface": "any", "allow-routing": 0, "comment": ""}
+        names = list(address_table) or ["all"]
+        group_table = {}
+        for index in range(groups):
+            members = names[index * 10 % len(names):index * 10 % len(names) + 10] or names[:1]
+            group_table[f"GROUP_{index}"] = {"name": f"GROUP_{index}", "member": members, "comment": ""}
+        package_table = {}
+        for index in range(packages):
+            name = "default" if index == 0 else f"package{index}"
+            rules = [{"policyid": policyid, "name": f"RULE_{policyid}", "srcintf": ["port1"], "dstintf": ["port2"],
+                      "srcaddr": [names[policyid % len(names)]], "dstaddr": ["all"], "service": ["ALL"],
+                      "schedule": ["always"], "action": 1, "logtraffic": 2, "comments": ""}
+                     for policyid in range(1, policies + 1)]
+            package_table[name] = {"package": {"name": name, "type": "pkg", "obj ver": 1}, "policies": rules}
+        services = {
+            "ALL": {"name": "ALL", "protocol": "IP", "protocol-number": 0},
+            "HTTP": {"name": "HTTP", "protocol": "TCP/UDP/SCTP", "tcp-portrange": ["80"]},
+            "HTTPS": {"name": "HTTPS", "protocol": "TCP/UDP/SCTP", "tcp-portrange": ["443"]},
+            "DNS": {"name": "DNS", "protocol": "TCP/UDP/SCTP", "tcp-portrange": ["53"], "udp-portrange": ["53"]},
+            "PING": {"name": "PING", "protocol": "ICMP"},
+        }
+        service_groups = {"Web Access": {"name": "Web Access", "member": ["DNS", "HTTP", "HTTPS"]}}
+        device_network = ipaddress.ip_network("172.16.0.0/12")
+        device_table = {}
+        for index in range(devices):
+            name = f"FGT-{index + 1:05d}"
+            device_table[name] = {"name": name, "sn": f"FGVM02TM{index + 1:08d}", "ip": str(device_network[index + 1]),
+                                  "platform_str": "FortiGate-VM64", "os_ver": 7, "mr": 2, "patch": 8, "build": 1639,
+                                  "ha_mode": 0, "conn_status": 1, "conf_status": 1, "db_status": 1, "dev_status": 1,
+                                  "mgmt_mode": 3, "vdom": [{"name": "root", "opmode": 1}]}
+        return {"address": address_table, "addrgrp": group_table, "service/custom": services,
+                "service/group": service_groups, "device": device_table, "packages": package_table}
+
+    # Server lifecycle
+    @property
+    def host(self):
+        """
+        Value to pass as host to FortiManager
+        """
+        return f"127.0.0.1:{self._server.server_address[1]}"
+
+    def start(self):
+        self._server = _Server(("127.0.0.1", self.port), _Handler)
+        self._server.mock = self
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def expire_sessions(self):
+        """
+        Forget every session, as if they had timed out on the appliance
+        """
+        with self._lock:
+            self.sessions.clear()
+
+    # JSON-RPC handling
+    def handle(self, request):
+        """
+        Answer a JSON-RPC request
+        :param request: Decoded request, None when the body was not valid JSON
+        :return: Encoded response
+        """
+        if self.latency:
+            time.sleep(self.latency)
+        if request is None:
+            return json.dumps({"id": None, "result": [{"status": {"code": -1, "message": "Invalid JSON"}}]}).encode()
+        with self._lock:
+            self.requests += 1
+            method = request.get("method")
+            response = {"id": request.get("id"), "result": []}
+            for params in request.get("params", []):
+                url = params.get("url", "").strip("/")
+                if url == "sys/login/user":
+                    data = params.get("data", {})
+                    if data.get("user") == self.username and data.get("passwd") == self.password:
+                        session = uuid.uuid4().hex
+                        self.sessions.add(session)
+                        response["session"] = session
+                        response["result"].append({"status": OK, "url": url})
+                    else:
+                        response["result"].append({"status": {"code": -22, "message": "Login fail"}, "url": url})
+                    continue
+                if request.get("session") not in self.sessions:
+                    response["result"].append({"status": NO_PERMISSION, "url": url})
+                    continue
+                if url == "sys/logout":
+                    self.sessions.discard(request.get("session"))
+                    response["result"].append({"status": OK, "url": url})
+                    continue
+                status, data = self._dispatch(method, url, params, request.get("session"))
+                entry = {"status": status, "url": url}
+                if data is not None:
+                    entry["data"] = data
+                response["result"].append(entry)
+            return json.dumps(response).encode("utf-8")
+
+    def _dispatch(self, method, url, params, session=None):
+        parts = url.split("/")
+        if parts[:2] == ["dvmdb", "adom"] and len(parts) >= 5 and parts[3] == "workspace":
+            return self._workspace(method, parts[2], parts[4:], session)
+        if self.workspace_mode and method != "get" and len(parts) >= 4 and parts[:3] in (["pm", "pkg", "adom"],
+                                                                                       ["pm", "config", "adom"]):
+            package = parts[5] if parts[1] == "config" and parts[4] == "pkg" else None
+            if self.locks.get((parts[3], None)) != session and self.locks.get((parts[3], package)) != session:
+                return NOT_LOCKED, None
+        if parts[:2] == ["dvmdb", "adom"] and len(parts) >= 4 and parts[3] == "device" and parts[2] in self.adoms:
+            return self._objects(method, self.adoms[parts[2]]["device"], parts[4:], params)
+        if parts[:2] == ["dvmdb", "adom"]:
+            return self._adoms(method, parts[2:], params)
+        if parts[:3] == ["pm", "pkg", "adom"] and len(parts) >= 4 and parts[3] in self.adoms:
+            return self._packages(method, self.adoms[parts[3]], parts[4:], params)
+        if parts[:3] == ["pm", "config", "adom"] and len(parts) >= 7 and parts[3] in self.adoms:
+            adom = self.adoms[parts[3]]
+            if parts[4:6] == ["obj", "firewall"] and parts[6] in ("address", "addrgrp"):
+                return self._objects(method, adom[parts[6]], parts[7:], params)
+            if parts[4:7] == ["obj", "firewall", "service"] and "/".join(parts[6:8]) in adom:
+                return self._objects(method, adom["/".join(parts[6:8])], parts[8:], params)
+            if parts[4] == "pkg" and parts[6:8] == ["firewall", "policy"] and parts[5] in adom["packages"]:
+                return self._policies(method, adom["packages"][parts[5]], parts[8:], params)
+            return NOT_FOUND, None
+        if url == "securityconsole/install/package" and method == "exec":
+            return self._install(params.get("data", {}))
+        if parts[:2] == ["task", "task"] and len(parts) >= 3 and method == "get":
+            return self._task(parts[2], parts[3:])
+        return INVALID_URL, None
+
+    def _workspace(self, method, adom, parts, session):
+        if method != "exec" or adom not in self.adoms or parts[0] not in ("lock", "commit", "unlock"):
+            return INVALID_URL, None
+        package = parts[2] if parts[1:2] == ["pkg"] and len(parts) > 2 else None
+        if package is not None and package not in self.adoms[adom]["packages"]:
+            return NOT_FOUND, None
+        key = (adom, package)
+        owner = self.locks.get(key)
+        if parts[0] == "lock":
+            if owner is not None and owner != session:
+                return LOCKED, None
+            self.locks[key] = session
+            if self.workspace_mode:
+                self._uncommitted.setdefault(key, self._workspace_state(key))
+            return OK, None
+        if owner != session:
+            return NOT_LOCKED, None
+        if parts[0] == "commit":
+            self.commits += 1
+            if self.workspace_mode:
+                self._uncommitted[key] = self._workspace_state(key)
+            return OK, None
+        del self.locks[key]
+        if key in self._uncommitted:
+            state = self._uncommitted.pop(key)
+            if package is None:
+                self.adoms[adom] = state
+            else:
+                self.adoms[adom]["packages"][package] = state
+        return OK, None
+
+    def _workspace_state(self, key):
+        adom, package = key
+        return copy.deepcopy(self.adoms[adom] if package is None else self.adoms[adom]["packages"][package])
+
+    def _adoms(self, method, parts, params):
+        if method != "get":
+            return INVALID_URL, None
+        entries = [{"name": name, "desc": "", "state": 1} for name in self.adoms]
+        if parts:
+            entries = [entry for entry in entries if entry["name"] == parts[0]]
+            return (OK, entries[0]) if entries else (NOT_FOUND, None)
+        return OK, self._query(entries, params)
+
+    def _packages(self, method, adom, parts, params):
+        packages = adom["packages"]
+        if method == "get":
+            if parts:
+                return (OK, dict(packages[parts[0]]["package"])) if parts[0] in packages else (NOT_FOUND, None)
+            return OK, self._query([package["package"] for package in packages.values()], params)
+        if method in ("set", "add"):
+            data = params.get("data", [])
+            for package in data if isinstance(data, list) else [data]:
+                packages.setdefault(package["name"], {"package": dict(package, **{"obj ver": 1}), "policies": []})
+            return OK, None
+        if method == "delete" and parts:
+            return (OK, None) if packages.pop(parts[0], None) else (NOT_FOUND, None)
+        return INVALID_URL, None
+
+    def _objects(self, method, table, parts, params):
+        data = params.get("data")
+        if parts and len(parts) > 1:
+            # Member level operations eg. pm/config/adom/root/obj/firewall/addrgrp/GROUP_1/member
+            entry = table.get(parts[0])
+            if entry is None:
+                return NOT_FOUND, None
+            members = entry.setdefault(parts[1], [])
+            values = data if isinstance(data, list) else [data]
+            if method == "add":
+                members.extend(value for value in values if value not in members)
+                return OK, None
+            if method == "delete":
+                entry[parts[1]] = [member for member in members if member not in values]
+                return OK, None
+            if method == "get":
+                return OK, list(members)
+            return INVALID_URL, None
+        if method == "get":
+            if parts:
+                entry = table.get(parts[0])
+                return (OK, self._project(entry, params.get("fields"))) if entry else (NOT_FOUND, None)
+            return OK, self._query(list(table.values()), params)
+        if method in ("add", "set"):
+            entries = data if isinstance(data, list) else [data]
+            for entry in entries:
+                if method == "add" and entry["name"] in table:
+                    return DUPLICATE, None
+                table[entry["name"]] = dict(table.get(entry["name"], {}), **entry)
+            return OK, {"name": entries[-1]["name"]} if entries else None
+        if method == "update" and parts:
+            entry = table.get(parts[0])
+            if entry is None:
+                return NOT_FOUND, None
+            entry.update(data or {})
+            if entry["name"] != parts[0]:
+                table[entry["name"]] = table.pop(parts[0])
+            return OK, {"name": entry["name"]}
+        if method == "delete" and parts:
+            return (OK, None) if table.pop(parts[0], None) else (NOT_FOUND, None)
+        return INVALID_URL, None
+
+    def _policies(self, method, package, parts, params):
+        rules = package["policies"]
+        by_id = {rule["policyid"]: rule for rule in rules}
+        data = params.get("data")
+        if method != "get":
+            package["package"]["obj ver"] += 1
+        if method == "get":
+            if parts:
+                rule = by_id.get(int(parts[0]))
+                return (OK, self._project(rule, params.get("fields"))) if rule else (NOT_FOUND, None)
+            return OK, self._query(rules, params)
+        if method in ("add", "set") and not parts:
+            entries = data if isinstance(data, list) else [data]
+            policyid = None
+            for entry in entries:
+                policyid = entry.get("policyid") or max(by_id, default=0) + 1
+                rule = dict(entry, policyid=policyid)
+                by_id[policyid] = rule
+                rules.append(rule)
+            return OK, {"policyid": policyid}
+        if not parts or int(parts[0]) not in by_id:
+            return NOT_FOUND, None
+        rule = by_id[int(parts[0])]
+        if method == "update":
+            rule.update(data or {})
+            return OK, {"policyid": rule["policyid"]}
+        if method == "delete":
+            rules.remove(rule)
+            return OK, None
+        if method == "move":
+            target = by_id.get(int(params.get("target", 0)))
+            if target is None or target is rule:
+                return NOT_FOUND, None
+            rules.remove(rule)
+            index = rules.index(target) + (params.get("option") == "after")
+            rules.insert(index, rule)
+            return OK, None
+        return INVALID_URL, None
+
+    def _install(self, data):
+        adom = self.adoms.get(data.get("adom"))
+        if adom is None or data.get("pkg") not in adom["packages"]:
+            return NOT_FOUND, None
+        task_id = next(self._task_ids)
+        devices = [device["name"] for device in data.get("scope") or [{"name": "FGT-01"}]]
+        self._tasks[task_id] = {"start": time.monotonic(), "title": f"Install {data['pkg']}", "devices": devices}
+        return OK, {"task": task_id}
+
+    def _task(self, task_id, parts):
+        task = self._tasks.get(int(task_id))
+        if task is None:
+            return NOT_FOUND, None
+        elapsed = time.monotonic() - task["start"]
+        percent = 100 if not self.install_duration else min(100, int(100 * elapsed / self.install_duration))
+        state = "done" if percent == 100 else "running"
+        if parts == ["line"]:
+            return OK, [{"name": device, "vdom": "root", "state": state, "percent": percent,
+                         "detail": "install and save finished status=OK" if state == "done" else ""}
+                        for device in task["devices"]]
+        return OK, {"id": int(task_id), "title": task["title"], "percent": percent, "state": state,
+                    "num_lines": len(task["devices"]), "num_done": len(task["devices"]) if state == "done" else 0,
+                    "num_err": 0}
+
+    # Request options
+    @classmethod
+    def _query(cls, entries, params):
+        if params.get("filter"):
+            entries = [entry for entry in entries if cls._match(entry, params["filter"])]
+        for sorting in reversed(params.get("sortings") or []):
+            for field, direction in sorting.items():
+                entries = sorted(entries, key=lambda entry: json.dumps(entry.get(field)), reverse=direction < 0)
+        if params.get("range"):
+            offset, limit = params["range"]
+            entries = entries[offset:offset + limit]
+        return [cls._project(entry, params.get("fields")) for entry in entries]
+
+    @staticmethod
+    def _project(entry, fields):
+        if not fields:
+            return dict(entry)
+        return {field: entry[field] for field in fields if field in entry}
+
+    @classmethod
+    def _match(cls, entry, expression):
+        if len(expression) == 3 and expression[1] in ("&&", "||"):
+            left, operator, right = expression
+            if operator == "&&":
+                return cls._match(entry, left) and cls._match(entry, right)
+            return cls._match(entry, left) or cls._match(entry, right)
+        field, operator, *values = expression
+        value = entry.get(field)
+        if operator == "==":
+            return value == values[0] or value == [values[0]]
+        if operator == "!=":
+            return value != values[0] and value != [values[0]]
+        if operator == "like":
+            return fnmatch.fnmatchcase(str(value), values[0].replace("%", "*").replace("_", "?"))
+        if operator == "contain":
+            return values[0] in (value or [])
+        if operator == "in":
+            return value in values
+        comparisons = {"<": value.__lt__, "<=": value.__le__, ">": value.__gt__, ">=": value.__ge__}
+        return comparisons[operator](values[0]) is True
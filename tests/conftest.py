@@ -0,0 +1,21 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+from pyFortiManagerAPI import FortiManager  # noqa: E402
+from pyFortiManagerMock import MockFortiManager  # noqa: E402
+
+
+@pytest.fixture
+def server():
+    with MockFortiManager(addresses=20, groups=5, policies=10, devices=3) as server:
+        yield server
+
+
+@pytest.fixture
+def fortimngr(server):
+    with FortiManager(host=server.host) as fortimngr:
+        yield fortimngr
@@ -0,0 +1,23 @@
+def test_results_map_to_their_calls(fortimngr):
+    batch = fortimngr.batch()
+    added = batch.add_firewall_address_object(name="NEW_1", subnet=["10.9.0.1", "255.255.255.255"])
+    duplicate = batch.add_firewall_address_object(name="HOST_10.0.0.1", subnet=["10.0.0.1", "255.255.255.255"])
+    group = batch.get_address_groups(name="GROUP_1")
+    missing = batch.get_address_groups(name="NO_SUCH_GROUP")
+    results = batch.execute()
+    assert results == [added.result, duplicate.result, group.result, missing.result]
+    assert added.result[0]["status"]["code"] == 0
+    assert duplicate.result[0]["status"]["code"] == -2
+    assert group.result[0]["data"]["name"] == "GROUP_1"
+    assert missing.result[0]["status"]["code"] == -3
+
+
+def test_calls_are_chunked(server, fortimngr):
+    batch = fortimngr.batch(chunk_size=2)
+    calls = [batch.add_firewall_address_object(name=f"NEW_{index}", subnet=[f"10.9.0.{index}", "255.255.255.255"])
+             for index in range(5)]
+    requests = server.requests
+    batch.execute()
+    assert server.requests - requests == 3
+    assert [call.result[0]["status"]["code"] for call in calls] == [0] * 5
+    assert len(fortimngr.get_firewall_address_objects(filter=["name", "like", "NEW_%"])[0]["data"]) == 5
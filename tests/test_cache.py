@@ -0,0 +1,25 @@
+from pyFortiManagerAPI import FortiManager
+
+
+def test_reads_are_cached_and_writes_invalidate(server):
+    with FortiManager(host=server.host, cache_ttl=300) as fortimngr:
+        fortimngr.get_firewall_address_objects()
+        requests = server.requests
+        fortimngr.get_firewall_address_objects()
+        assert server.requests == requests
+
+        fortimngr.add_firewall_address_object(name="NEW_1", subnet=["10.9.0.1", "255.255.255.255"])
+        names = [entry["name"] for entry in fortimngr.get_firewall_address_objects()[0]["data"]]
+        assert "NEW_1" in names
+        assert fortimngr.get_firewall_address_objects(name="NEW_1")[0]["status"]["code"] == 0
+
+        fortimngr.delete_firewall_address_object("NEW_1")
+        assert fortimngr.get_firewall_address_objects(name="NEW_1")[0]["status"]["code"] == -3
+
+
+def test_paged_reads_are_not_cached(server):
+    with FortiManager(host=server.host, cache_ttl=300) as fortimngr:
+        list(fortimngr.iter_firewall_address_objects(page_size=10))
+        requests = server.requests
+        list(fortimngr.iter_firewall_address_objects(page_size=10))
+        assert server.requests - requests == 3
@@ -0,0 +1,35 @@
+from pyFortiManagerAPI import AddressImporter
+
+ROWS = """name,type,subnet,start-ip,end-ip,member
+NEW_1,,10.9.0.1/32,,,
+HOST_10.0.0.1,,10.0.0.1/32,,,
+BAD_RANGE,iprange,,10.9.0.9,10.9.0.1,
+BAD_SUBNET,,300.0.0.0/24,,,
+NEW_GROUP,,,,,NEW_1;HOST_10.0.0.1
+BROKEN_GROUP,,,,,NEW_1;BAD_SUBNET
+"""
+
+
+def run(fortimngr, tmp_path, rows, name="rows.csv"):
+    path = tmp_path / name
+    path.write_text(rows)
+    report = tmp_path / "report.csv"
+    summary = AddressImporter(fortimngr, chunk_size=2).run(str(path), report_path=str(report))
+    statuses = {line.split(",")[1]: line.split(",")[3] for line in report.read_text().splitlines()[1:]}
+    return summary, statuses
+
+
+def test_statuses(fortimngr, tmp_path):
+    summary, statuses = run(fortimngr, tmp_path, ROWS)
+    assert summary == {"ok": 2, "exists": 1, "error": 0, "invalid": 2, "skipped": 1}
+    assert statuses == {"NEW_1": "ok", "HOST_10.0.0.1": "exists", "BAD_RANGE": "invalid", "BAD_SUBNET": "invalid",
+                        "NEW_GROUP": "ok", "BROKEN_GROUP": "skipped"}
+    group = fortimngr.get_address_groups(name="NEW_GROUP")[0]["data"]
+    assert group["member"] == ["NEW_1", "HOST_10.0.0.1"]
+    assert fortimngr.get_address_groups(name="BROKEN_GROUP")[0]["status"]["code"] == -3
+
+
+def test_bad_json_lines_do_not_stop_the_import(fortimngr, tmp_path):
+    rows = '{"name": "NEW_1", "subnet": "10.9.0.1/32"}\n{"name": bad\n["NEW_2"]\n{"name": "NEW_3", "fqdn": "a.com"}\n'
+    summary, _ = run(fortimngr, tmp_path, rows, name="rows.jsonl")
+    assert summary == {"ok": 2, "exists": 0, "error": 0, "invalid": 2, "skipped": 0}
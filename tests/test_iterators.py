@@ -0,0 +1,19 @@
+import pytest
+
+
+def test_pages_cover_the_table(server, fortimngr):
+    expected = [entry["name"] for entry in fortimngr.get_firewall_address_objects(fields=["name"])[0]["data"]]
+    requests = server.requests
+    names = [entry["name"] for entry in fortimngr.iter_firewall_address_objects(page_size=7, fields=["name"])]
+    assert names == expected
+    # 7 + 7 + 6 entries, the short page ends the iteration
+    assert server.requests - requests == 3
+
+
+def test_exact_multiple_of_page_size(fortimngr):
+    assert len(list(fortimngr.iter_firewall_address_objects(page_size=10))) == 20
+
+
+def test_page_size_must_be_positive(fortimngr):
+    with pytest.raises(ValueError):
+        list(fortimngr.iter_firewall_address_objects(page_size=0))
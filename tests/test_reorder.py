@@ -0,0 +1,56 @@
+import random
+
+import pytest
+
+from pyFortiManagerAPI import _minimal_moves
+
+
+def apply_moves(order, moves):
+    order = list(order)
+    for item, option, anchor in moves:
+        order.remove(item)
+        order.insert(order.index(anchor) + (option == "after"), item)
+    return order
+
+
+@pytest.mark.parametrize("target", [
+    [1, 2, 3, 4, 5],
+    [5, 4, 3, 2, 1],
+    [2, 3, 4, 5, 1],
+    [5, 1, 2, 3, 4],
+    [1, 3, 2, 5, 4],
+])
+def test_minimal_moves_reach_the_target(target):
+    moves = _minimal_moves([1, 2, 3, 4, 5], target)
+    assert apply_moves([1, 2, 3, 4, 5], moves) == target
+
+
+def test_minimal_moves_count():
+    assert _minimal_moves([1, 2, 3], [1, 2, 3]) == []
+    # Only the displaced item moves
+    assert len(_minimal_moves(list(range(100)), [99] + list(range(99)))) == 1
+    shuffled = list(range(200))
+    random.Random(1).shuffle(shuffled)
+    assert apply_moves(range(200), _minimal_moves(list(range(200)), shuffled)) == shuffled
+
+
+def policyids(fortimngr):
+    return [policy["policyid"] for policy in fortimngr.get_firewall_policies("default")[0]["data"]]
+
+
+def test_reorder_firewall_policies(fortimngr):
+    wanted = [10] + list(range(1, 10))
+    dry_run = fortimngr.reorder_firewall_policies("default", wanted, dry_run=True)
+    assert [move["result"] for move in dry_run] == [None]
+    assert policyids(fortimngr) == list(range(1, 11))
+
+    moves = fortimngr.reorder_firewall_policies("default", wanted)
+    assert len(moves) == 1
+    assert moves[0]["result"][0]["status"]["code"] == 0
+    assert policyids(fortimngr) == wanted
+    assert fortimngr.reorder_firewall_policies("default", wanted) == []
+
+
+def test_reorder_rejects_unknown_policies(fortimngr):
+    with pytest.raises(ValueError):
+        fortimngr.reorder_firewall_policies("default", [1, 99])
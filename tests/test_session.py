@@ -0,0 +1,27 @@
+from pyFortiManagerAPI import FortiManager
+
+
+def test_session_is_reused(server, fortimngr):
+    sessionid = fortimngr.sessionid
+    for _ in range(3):
+        assert fortimngr.get_adoms()[0]["status"]["code"] == 0
+    assert fortimngr.sessionid == sessionid
+    assert server.sessions == {sessionid}
+
+
+def test_relogin_after_session_expired(server, fortimngr):
+    sessionid = fortimngr.sessionid
+    server.expire_sessions()
+    result = fortimngr.get_firewall_address_objects(fields=["name"])
+    assert result[0]["status"]["code"] == 0
+    assert len(result[0]["data"]) == 20
+    assert fortimngr.sessionid != sessionid
+    assert fortimngr.sessionid in server.sessions
+
+
+def test_logout_on_close(server):
+    fortimngr = FortiManager(host=server.host)
+    fortimngr.login()
+    assert len(server.sessions) == 1
+    fortimngr.close()
+    assert not server.sessions
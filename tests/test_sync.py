@@ -0,0 +1,27 @@
+from pyFortiManagerAPI import SyncEngine
+
+DESIRED = {
+    "addresses": [{"name": "SYNC_1", "subnet": ["10.9.0.1", "255.255.255.255"]},
+                  {"name": "SYNC_2", "subnet": ["10.9.0.2", "255.255.255.255"]}],
+    "groups": [{"name": "SYNC_GROUP", "member": ["SYNC_1", "SYNC_2"]}],
+    "policies": [{"name": "SYNC_RULE", "srcintf": ["port1"], "dstintf": ["port2"], "srcaddr": ["SYNC_GROUP"],
+                  "dstaddr": ["all"], "service": ["ALL"], "schedule": ["always"], "action": 1}],
+}
+
+
+def test_rerun_is_a_no_op(server, fortimngr):
+    engine = SyncEngine(fortimngr)
+    plan = engine.sync(DESIRED)
+    assert plan.summary() == {"address add": 2, "group add": 1, "policy add": 1}
+    assert plan.errors == []
+
+    requests = server.requests
+    assert len(engine.sync(DESIRED)) == 0
+    assert server.requests - requests == 1
+
+
+def test_no_prune_by_default(fortimngr):
+    desired = {"addresses": DESIRED["addresses"]}
+    assert SyncEngine(fortimngr).plan(desired).summary() == {"address add": 2}
+    pruned = SyncEngine(fortimngr, prune=True).plan(desired).summary()
+    assert pruned == {"address add": 2, "address delete": 20}
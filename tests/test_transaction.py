@@ -0,0 +1,44 @@
+import pytest
+
+from pyFortiManagerAPI import FortiManager
+from pyFortiManagerMock import MockFortiManager
+
+SUBNET = ["10.9.0.1", "255.255.255.255"]
+
+
+@pytest.fixture
+def workspace():
+    with MockFortiManager(addresses=5, policies=5, workspace_mode=True) as server:
+        yield server
+
+
+def test_commit(workspace):
+    with FortiManager(host=workspace.host) as fortimngr:
+        with fortimngr.transaction() as batch:
+            batch.add_firewall_address_object(name="NEW_1", subnet=SUBNET)
+        assert fortimngr.get_firewall_address_objects(name="NEW_1")[0]["status"]["code"] == 0
+        assert workspace.commits == 1
+        assert not workspace.locks
+
+
+def test_rollback_discards_changes_and_cached_reads(workspace):
+    with FortiManager(host=workspace.host, cache_ttl=300) as fortimngr:
+        with pytest.raises(RuntimeError):
+            with fortimngr.transaction() as batch:
+                batch.add_firewall_address_object(name="NEW_1", subnet=SUBNET)
+                batch.execute()
+                assert fortimngr.get_firewall_address_objects(name="NEW_1")[0]["status"]["code"] == 0
+                raise RuntimeError("abort")
+        assert fortimngr.get_firewall_address_objects(name="NEW_1")[0]["status"]["code"] == -3
+        assert workspace.commits == 0
+        assert not workspace.locks
+
+
+def test_failed_operation_rolls_back(workspace):
+    with FortiManager(host=workspace.host) as fortimngr:
+        with pytest.raises(Exception):
+            with fortimngr.transaction() as batch:
+                batch.add_firewall_address_object(name="NEW_1", subnet=SUBNET)
+                batch.add_firewall_address_object(name="HOST_10.0.0.1", subnet=SUBNET)
+        assert fortimngr.get_firewall_address_objects(name="NEW_1")[0]["status"]["code"] == -3
+        assert not workspace.locks